@@ -0,0 +1,121 @@
+"""
+A stale-while-revalidate cache on top of the Django cache.
+
+Values are stored with the time they were computed. A value younger than
+`timeout` is returned as it is. An older value is still returned, and one
+caller (whoever gets the refresh lock) recomputes it in the background, so
+only one request per key ever waits for or triggers the expensive call. If
+recomputing fails, the last good value keeps being served until it is
+`stale_timeout` seconds old.
+
+When there is no value at all, the caller holding the lock computes it while
+the others wait for it for up to `lock_timeout` seconds. If computing it
+fails, the exception is kept for `error_timeout` seconds and the waiting
+callers raise it as well, rather than waiting out `lock_timeout`. If it
+can't be kept (it doesn't pickle), the next waiter takes the lock and
+computes the value itself.
+"""
+import logging
+import os
+import time
+
+from .executor import BoundedExecutor
+
+log = logging.getLogger(__name__)
+
+# Background refreshes shared by all caches, refreshes are dropped (and retried by a later request) when it is full
+_refresh_executor = BoundedExecutor('StaleWhileRevalidateCache', workers=2, queue_size=100)
+
+
+class StaleWhileRevalidateCache(object):
+    def __init__(self, prefix, timeout, stale_timeout, lock_timeout=30, poll_interval=0.1, error_timeout=5):
+        self.prefix = prefix
+        self.timeout = timeout
+        self.stale_timeout = stale_timeout
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.error_timeout = error_timeout
+
+    @property
+    def cache(self):
+        # Imported at call-time, the cache is not necessarily configured when this module is loaded
+        from django.core.cache import cache
+        return cache
+
+    def _key(self, key):
+        return '%s:%s' % (self.prefix, key)
+
+    def _lock_key(self, key):
+        return '%s:%s:lock' % (self.prefix, key)
+
+    def _error_key(self, key):
+        return '%s:%s:error' % (self.prefix, key)
+
+    def get(self, key, compute, background=True):
+        """ The cached value for key, computing it with compute() if needed.
+            Raises whatever compute() raised if there is no value to fall back to.
+        """
+        entry = self.cache.get(self._key(key))
+        if entry is not None:
+            if time.time() - entry['computed'] >= self.timeout and self._lock(key):
+                if not background:
+                    return self._refresh(key, compute, entry)['value']
+                if _refresh_executor.submit(self._refresh, key, compute, entry) is None:
+                    self._unlock(key)
+            return entry['value']
+
+        if not self._lock(key):
+            # Someone else is computing it, wait for their result
+            deadline = time.time() + self.lock_timeout
+            while time.time() < deadline:
+                time.sleep(self.poll_interval)
+                entry = self.cache.get(self._key(key))
+                if entry is not None:
+                    return entry['value']
+                if self.cache.get(self._lock_key(key)) is None:
+                    # The lock was released without a value, computing it failed
+                    error = self.cache.get(self._error_key(key))
+                    if error is not None:
+                        raise error
+                    if self._lock(key):
+                        return self._refresh(key, compute, None, reraise=True)['value']
+            log.warning("Timed out waiting for %s, computing it" % self._key(key))
+            return compute()
+        return self._refresh(key, compute, None, reraise=True)['value']
+
+    def _refresh(self, key, compute, entry, reraise=False):
+        """ Compute and store a new value, returns the new entry or the old one on failure
+        """
+        try:
+            value = compute()
+        except Exception as e:
+            if entry is None:
+                self._set_error(key, e)
+            if reraise or entry is None:
+                raise
+            log.exception("Failed refreshing %s, serving the last good value" % self._key(key))
+            return entry
+        finally:
+            self._unlock(key)
+        if entry is None:
+            self.cache.delete(self._error_key(key))
+        entry = {'value': value, 'computed': time.time()}
+        self.cache.set(self._key(key), entry, self.stale_timeout)
+        return entry
+
+    def _set_error(self, key, error):
+        """ Keep the failure of computing a missing value for the callers waiting for it
+        """
+        try:
+            self.cache.set(self._error_key(key), error, self.error_timeout)
+        except Exception:
+            log.debug("Can't keep the failure of %s for the waiting callers" % self._key(key))
+
+    def _lock(self, key):
+        return self.cache.add(self._lock_key(key), os.getpid(), self.lock_timeout)
+
+    def _unlock(self, key):
+        self.cache.delete(self._lock_key(key))
+
+    def invalidate(self, key):
+        self.cache.delete(self._key(key))
@@ -3,10 +3,13 @@ This module contains example dashboard widgets.
 """
 import logging
 
-from django.utils.translation import ugettext as _
+from django.utils.translation import ugettext as _, ugettext_lazy as _lazy
 
 from portal.pluginbase.core import Plugin, implements
 from portal.generic.dashboard_interfaces import IDashboardWidget
+
+from .widgetcache import cached_render_data
+from .widgetrender import memoized_config_form, register_widget
 # Note: The following package must be imported at call-time in methods to prevent circular dependencies:
 # from django import forms
 # from django.core.cache import cache
@@ -35,7 +38,7 @@ class HelloWidget(Plugin):
         return render_data
 
 
-HelloWidget()
+register_widget(HelloWidget())
 
 
 class DummyWidget(Plugin):
@@ -61,12 +64,14 @@ class DummyWidget(Plugin):
         return render_data
 
 # This registers the widget plugin
-DummyWidget()
+register_widget(DummyWidget())
 
 
 class TextWidget(Plugin):
     """
     A basic widget with configurable text and title
+
+    The render data only depends on the settings, so it is cached for all users with cached_render_data.
     """
     implements(IDashboardWidget)
 
@@ -81,6 +86,7 @@ class TextWidget(Plugin):
         return _("Text widget")
 
     @staticmethod
+    @cached_render_data('TextWidget', timeout=300)
     def get_render_data(render_data, settings, request):
         # Update widget title from settings if user has edited the text
         if 'title' in settings:
@@ -93,11 +99,13 @@ class TextWidget(Plugin):
         return render_data
 
     @staticmethod
+    @memoized_config_form
     def get_config_form(settings, request):
         from django import forms
 
         class TextWidgetSettingsForm(forms.Form):
-            title = forms.CharField(label='Widget title', max_length=100, initial=TextWidget.get_list_title())
+            # Called when the form is shown, the form class is shared by all users and languages
+            title = forms.CharField(label='Widget title', max_length=100, initial=TextWidget.get_list_title)
             text = forms.CharField(label='Widget text', max_length=10000, widget=forms.Textarea(attrs={'rows': 5}))
 
         return TextWidgetSettingsForm
@@ -107,7 +115,7 @@ class TextWidget(Plugin):
         return False
 
 # This registers the widget plugin
-TextWidget()
+register_widget(TextWidget())
 
 
 class TextWidgetForcedConfig(TextWidget):
@@ -134,15 +142,16 @@ class TextWidgetForcedConfig(TextWidget):
         return 'text' not in settings or not settings['text']
 
 
-TextWidgetForcedConfig()
+register_widget(TextWidgetForcedConfig())
 
 
 class RefreshWidget(Plugin):
     """
     Example of a widget that automatically refreshes every 10 seconds.
 
-    Uses custom template which does JS reload using
-    cntmo.app.dashboard.reloadWidgetAfter(id, time_ms)-function.
+    Uses custom template which polls RefreshWidgetFeedView for new content instead of reloading the
+    whole widget with cntmo.app.dashboard.reloadWidgetAfter(id, time_ms). The feed computes the
+    content once per interval for all open dashboards, see widgetfeed.py.
     """
     implements(IDashboardWidget)
 
@@ -173,6 +182,7 @@ class RefreshWidget(Plugin):
         return render_data
 
     @staticmethod
+    @memoized_config_form
     def get_config_form(settings, request):
         # Django classes MUST be imported inside method, not when package
         # is initialized
@@ -180,7 +190,7 @@ class RefreshWidget(Plugin):
 
         class RefreshWidgetSettingsForm(forms.Form):
             refresh_interval = forms.IntegerField(
-                label=_('Refresh interval (seconds):'),
+                label=_lazy('Refresh interval (seconds):'),
                 initial=RefreshWidget.default_interval, min_value=1)
 
         return RefreshWidgetSettingsForm
@@ -190,13 +200,13 @@ class RefreshWidget(Plugin):
         return False
 
 # Register widget plugin
-RefreshWidget()
+register_widget(RefreshWidget())
 
 
 class ConfigTestWidget(Plugin):
     """
     Test widget for all types of supported configuration fields. When configuration is saved, shows all stored
-    settings-values and their types.
+    settings-values and their types. The render data is cached per settings with cached_render_data.
 
     Note: Django fields DateField, MultipleChoiceField and DecimalField are NOT supported in widgets.
     """
@@ -213,6 +223,7 @@ class ConfigTestWidget(Plugin):
         return _("Configuration test widget")
 
     @staticmethod
+    @cached_render_data('ConfigTestWidget', timeout=300)
     def get_render_data(render_data, settings, request):
         content = 'All settings values:'
         for key, value in sorted(settings.items()):
@@ -222,6 +233,7 @@ class ConfigTestWidget(Plugin):
         return render_data
 
     @staticmethod
+    @memoized_config_form
     def get_config_form(settings, request):
         from django import forms
 
@@ -244,4 +256,4 @@ class ConfigTestWidget(Plugin):
         return False
 
 
-ConfigTestWidget()
+register_widget(ConfigTestWidget())
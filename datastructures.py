@@ -0,0 +1,179 @@
+"""
+Small in-memory data structures used by the plugin's signal listeners.
+
+These are not thread-safe on their own, callers are expected to hold a lock.
+"""
+from collections import OrderedDict
+
+
+class BoundedOrderedSet(object):
+    """ A set that remembers insertion order and holds at most `capacity` entries.
+
+        Membership tests, adds and removals are O(1). When the set is full, either
+        the oldest entry is evicted to make room (evict=True), or the new entry is
+        rejected (evict=False). Both cases are counted, in `evictions` and
+        `overflows` respectively.
+    """
+    def __init__(self, capacity, evict=True):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.evict = evict
+        self.evictions = 0
+        self.overflows = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, entry):
+        return entry in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __repr__(self):
+        return '<BoundedOrderedSet %d/%d>' % (len(self._entries), self.capacity)
+
+    def add(self, entry):
+        """ Add an entry. Returns False if it was rejected because the set is full.
+            Adding an entry which is already present keeps its original position.
+        """
+        if entry in self._entries:
+            return True
+        if len(self._entries) >= self.capacity:
+            if not self.evict:
+                self.overflows += 1
+                return False
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        self._entries[entry] = None
+        return True
+
+    def update(self, entries):
+        """ Add all entries, returns the number of entries that were rejected
+        """
+        rejected = 0
+        for entry in entries:
+            if not self.add(entry):
+                rejected += 1
+        return rejected
+
+    def discard(self, entry):
+        self._entries.pop(entry, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def drain(self, limit=None):
+        """ Remove and return up to `limit` of the oldest entries (all of them if limit is None)
+        """
+        if limit is None or limit >= len(self._entries):
+            entries = list(self._entries)
+            self._entries.clear()
+            return entries
+        entries = []
+        while len(entries) < limit:
+            entries.append(self._entries.popitem(last=False)[0])
+        return entries
+
+
+class LibraryIndex(object):
+    """ The libraries put in a collection, oldest first, and the items they hold.
+
+        Items are added to a collection a library at a time, so the collection
+        can only be trimmed by removing whole libraries. An item that is added
+        again moves to the newer library, and a library whose items have all
+        moved on no longer adds anything to the collection. Used to trim the
+        collection without reading it back from Vidispine.
+    """
+    def __init__(self):
+        # library id -> (timestamp, items for which it is the newest library)
+        self._libraries = OrderedDict()
+        self._item_libraries = {}
+
+    def __len__(self):
+        """ The number of items
+        """
+        return len(self._item_libraries)
+
+    def __contains__(self, item):
+        return item in self._item_libraries
+
+    def libraries(self):
+        return list(self._libraries)
+
+    def add(self, library_id, items, timestamp):
+        """ Record that a library of the items was added at `timestamp`, making it the newest library
+        """
+        current = set()
+        for item in items:
+            previous = self._item_libraries.get(item)
+            if previous is not None and previous != library_id:
+                self._libraries[previous][1].discard(item)
+            self._item_libraries[item] = library_id
+            current.add(item)
+        self._libraries[library_id] = (timestamp, current)
+
+    def remove(self, library_id):
+        """ Forget a library, and the items for which it was the newest library
+        """
+        _timestamp, items = self._libraries.pop(library_id, (None, ()))
+        for item in items:
+            self._item_libraries.pop(item, None)
+
+    def expired(self, now, max_items=None, max_age=None, limit=None):
+        """ Return the oldest libraries which hold no items that aren't in a newer library, are older
+            than `max_age` seconds or hold the oldest items beyond `max_items`, at most `limit` of them.
+            The libraries are not removed.
+        """
+        remaining = len(self._item_libraries)
+        libraries = []
+        # Libraries emptied by newer ones can be anywhere, so all of them are looked at
+        for library_id, (timestamp, items) in self._libraries.items():
+            if limit is not None and len(libraries) >= limit:
+                break
+            if (not items or (max_items is not None and remaining > max_items)
+                    or (max_age is not None and now - timestamp > max_age)):
+                libraries.append(library_id)
+                remaining -= len(items)
+        return libraries
+
+
+class LRUCache(object):
+    """ A mapping of at most `capacity` entries which expire `timeout` seconds after they were set.
+
+        When full, the least recently used entry is evicted.
+    """
+    def __init__(self, capacity, timeout):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.timeout = timeout
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, now, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires <= now:
+            return default
+        # Most recently used entries go last
+        self._entries[key] = entry
+        return value
+
+    def set(self, key, value, now):
+        self._entries.pop(key, None)
+        if len(self._entries) >= self.capacity:
+            self._entries.popitem(last=False)
+        self._entries[key] = (now + self.timeout, value)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
@@ -0,0 +1,191 @@
+"""
+A small bounded thread pool for work that should not hold up a request.
+
+Unlike an unbounded pool, the queue of waiting tasks has a fixed size. When it
+is full a task is either dropped, or the submitting thread blocks until there
+is room (optionally for a limited time), depending on the policy.
+"""
+import logging
+import os
+import threading
+import time
+import weakref
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+DROP = 'drop'
+BLOCK = 'block'
+
+# Every executor in the process, for the queue depth gauge
+_executors = weakref.WeakSet()
+
+REJECTED = metrics.counter('portalplugintemplate_executor_rejected_total',
+                           "Calls dropped because a thread pool queue was full", ['executor'])
+
+
+class Task(object):
+    """ A submitted call, whose result can be waited for
+    """
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.submitted = time.time()
+        self.value = None
+        self.exception = None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            self.exception = e
+            raise
+        finally:
+            self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """ Wait for the call to finish and return its value, or raise its exception
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("Task did not finish in %s seconds" % timeout)
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+
+class BoundedExecutor(object):
+    """ Runs submitted calls on up to `workers` daemon threads, with at most `queue_size`
+        calls waiting. Threads are started on the first submit in each process, so an
+        executor created before a fork works in the forked processes too.
+    """
+    def __init__(self, name, workers=2, queue_size=100, policy=DROP, block_timeout=None):
+        if policy not in (DROP, BLOCK):
+            raise ValueError("policy must be '%s' or '%s'" % (DROP, BLOCK))
+        self.name = name
+        self.workers = workers
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self._total_latency = 0.0
+        self._queue = queue.Queue(queue_size)
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        _executors.add(self)
+
+    def _ensure_threads(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._threads = []
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._run, name='%s-%d' % (self.name, number))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+
+    def submit(self, func, *args, **kwargs):
+        """ Queue a call. Returns its Task, or None if the queue was full and the call was dropped
+        """
+        self._ensure_threads()
+        task = Task(func, args, kwargs)
+        try:
+            if self.policy == BLOCK:
+                self._queue.put(task, True, self.block_timeout)
+            else:
+                self._queue.put_nowait(task)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            REJECTED.inc(self.name)
+            log.warning("%s queue is full, dropped %s" % (self.name, getattr(func, '__name__', func)))
+            return None
+        with self._lock:
+            self.submitted += 1
+        return task
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            failed = False
+            try:
+                task.run()
+            except Exception:
+                failed = True
+                log.exception("Task failed in %s" % self.name)
+            finally:
+                self._close_connections()
+            latency = time.time() - task.submitted
+            with self._lock:
+                if failed:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+                self.last_latency = latency
+                self.max_latency = max(self.max_latency, latency)
+                self._total_latency += latency
+
+    @staticmethod
+    def _close_connections():
+        # Tasks may use the ORM, don't keep connections around longer than Django would
+        try:
+            from django.db import close_old_connections
+        except ImportError:
+            return
+        close_old_connections()
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def shutdown(self, timeout=None):
+        """ Let the threads finish the queued calls and stop
+        """
+        if self._pid != os.getpid():
+            return
+        for _thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._pid = None
+
+    def stats(self):
+        """ Queue depth, counters and latency (queue wait plus run time) in seconds
+        """
+        with self._lock:
+            finished = self.completed + self.failed
+            return {
+                'queue_depth': self.queue_depth(),
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'last_latency': self.last_latency,
+                'max_latency': self.max_latency,
+                'avg_latency': self._total_latency / finished if finished else 0.0,
+            }
+
+
+metrics.gauge('portalplugintemplate_executor_queue_depth', "Calls waiting in the plugin's thread pools",
+              lambda: dict(((executor.name,), executor.queue_depth()) for executor in list(_executors)),
+              ['executor'])
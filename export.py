@@ -0,0 +1,65 @@
+"""
+Streaming export of MyPluginModel rows as CSV or JSON Lines.
+
+Rows are read in primary key order a chunk at a time (keyset pagination),
+so memory use stays constant however many rows are exported, and the first
+bytes can be sent as soon as the first chunk has been read.
+"""
+import csv
+import json
+import sys
+
+PY2 = sys.version_info[0] == 2
+
+# Rows per query
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_FIELDS = ('id', 'name', 'description', 'external_id')
+
+
+def iter_rows(queryset, fields=EXPORT_FIELDS, chunk_size=EXPORT_CHUNK_SIZE):
+    """ Value tuples of all rows in a queryset, read a chunk at a time in pk order.
+        The first field must be the primary key.
+    """
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(chunk.order_by('pk').values_list(*fields)[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        last_pk = rows[-1][0]
+
+
+class _Echo(object):
+    """ A file-like object whose write() returns what was written, for csv.writer
+    """
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if PY2 and isinstance(value, unicode):  # noqa: F821 (Python 2 only)
+        return value.encode('utf-8')
+    return value
+
+
+def csv_lines(rows, fields=EXPORT_FIELDS):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([_csv_value(value) for value in row])
+
+
+def jsonl_lines(rows, fields=EXPORT_FIELDS):
+    for row in rows:
+        yield json.dumps(dict(zip(fields, row))) + '\n'
+
+
+# format -> (line generator, content type, file extension)
+EXPORT_FORMATS = {
+    'csv': (csv_lines, 'text/csv; charset=utf-8', 'csv'),
+    'jsonl': (jsonl_lines, 'application/x-ndjson; charset=utf-8', 'jsonl'),
+}
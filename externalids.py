@@ -0,0 +1,80 @@
+"""
+Batch resolving of external ids to MyPluginModel rows.
+
+Integrations map many external ids at a time, so all ids that aren't cached
+are resolved with a single query. Resolved ids, including ids without any
+rows, are kept in a small per-process LRU for RESOLVE_CACHE_TIMEOUT seconds.
+Saving or deleting a row through the ORM drops its external id from this
+process' cache, as does forget_external_ids() for changes made without
+signals such as bulk imports. Changes made elsewhere are picked up when the
+entry expires.
+"""
+import threading
+import time
+
+from .datastructures import LRUCache
+from .models import MyPluginModel
+
+# Max number of external ids resolved in one call
+RESOLVE_MAX_IDS = 1000
+RESOLVE_CACHE_SIZE = 10000
+RESOLVE_CACHE_TIMEOUT = 60
+
+_cache = LRUCache(RESOLVE_CACHE_SIZE, RESOLVE_CACHE_TIMEOUT)
+_lock = threading.Lock()
+
+
+def resolve_external_ids(external_ids):
+    """ Map external ids to the MyPluginModels that have them, as {external id: [MyPluginModel, ...]}.
+        Ids without any rows map to an empty list. Raises ValueError for more than RESOLVE_MAX_IDS ids.
+    """
+    external_ids = set(external_ids)
+    if len(external_ids) > RESOLVE_MAX_IDS:
+        raise ValueError("Can't resolve more than %d external ids at a time" % RESOLVE_MAX_IDS)
+    resolved = {}
+    missing = []
+    now = time.time()
+    with _lock:
+        for external_id in external_ids:
+            objs = _cache.get(external_id, now)
+            if objs is None:
+                missing.append(external_id)
+            else:
+                resolved[external_id] = list(objs)
+    if missing:
+        found = dict((external_id, []) for external_id in missing)
+        for obj in MyPluginModel.objects.by_external_ids(missing).order_by('pk'):
+            found[obj.external_id].append(obj)
+        with _lock:
+            for external_id, objs in found.items():
+                _cache.set(external_id, tuple(objs), now)
+        resolved.update(found)
+    return resolved
+
+
+def receiver_mypluginmodel_saving(sender, instance, **kwargs):
+    """ The subscriber function to pre_save of MyPluginModel, remembers the external id the
+        row had so it is dropped from the cache too if it changes
+    """
+    if instance.pk is None:
+        return
+    instance._previous_external_id = (MyPluginModel.objects.filter(pk=instance.pk)
+                                      .values_list('external_id', flat=True).first())
+
+
+def receiver_mypluginmodel_changed(sender, instance, **kwargs):
+    """ The subscriber function to post_save and post_delete of MyPluginModel
+    """
+    external_ids = [instance.external_id]
+    previous = instance.__dict__.pop('_previous_external_id', None)
+    if previous is not None and previous != instance.external_id:
+        external_ids.append(previous)
+    forget_external_ids(external_ids)
+
+
+def forget_external_ids(external_ids):
+    """ Drop external ids from the cache, after their rows were changed without post_save
+    """
+    with _lock:
+        for external_id in external_ids:
+            _cache.delete(external_id)
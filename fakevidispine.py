@@ -0,0 +1,107 @@
+"""
+A fake Vidispine HTTP server, for running VSClient.request() without Vidispine.
+
+    server = FakeVidispine()
+    server.respond('GET', 'item/VX-1/shape', 503)
+    server.respond('GET', 'item/VX-1/shape', 200, '<ShapeListDocument/>')
+    server.start()
+    client = VSClient(base_url=server.base_url, username='admin', password='admin')
+    ...
+    server.stop()
+
+Responses are given per method and path (relative to /API/) and are returned
+in order, the last one for all later requests. Paths without responses get a
+404. The requests received are kept in `requests`, with lower case header names
+and the client address, which tells whether a connection was reused. The
+server keeps connections alive, as Vidispine does.
+"""
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive, as Vidispine
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self):
+        fake = self.server.fake
+        url = urlsplit(self.path)
+        path = url.path[len('/API/'):] if url.path.startswith('/API/') else url.path.lstrip('/')
+        length = int(self.headers.get('Content-Length') or 0)
+        fake.requests.append({'method': self.command, 'path': path, 'params': parse_qs(url.query),
+                              'client': self.client_address,
+                              'headers': dict((name.lower(), value) for name, value in self.headers.items()),
+                              'body': self.rfile.read(length) if length else b''})
+        status, body, headers = fake.next_response(self.command, path)
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    # Connections kept alive by clients don't hold up stop()
+    daemon_threads = True
+
+
+class FakeVidispine(object):
+    def __init__(self, host='127.0.0.1', port=0):
+        self.requests = []
+        self._responses = {}
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+    def respond(self, method, path, status=200, body='', headers=None):
+        """ Add a response for requests of the method to the path
+        """
+        with self._lock:
+            self._responses.setdefault((method, path), []).append(
+                (status, body, headers or {'Content-Type': 'application/xml'}))
+
+    def next_response(self, method, path):
+        with self._lock:
+            responses = self._responses.get((method, path))
+            if not responses:
+                return 404, 'No such resource', {'Content-Type': 'text/plain'}
+            return responses.pop(0) if len(responses) > 1 else responses[0]
+
+    def reset(self):
+        with self._lock:
+            self._responses = {}
+            del self.requests[:]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='FakeVidispine')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
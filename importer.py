@@ -0,0 +1,190 @@
+"""
+Bulk import of MyPluginModel rows from CSV or JSON Lines.
+
+Files are parsed as a stream and imported in batches of IMPORT_BATCH_SIZE
+rows. Each row is validated with the field rules of MyPluginForm and the
+model, without building a form per row. Every batch is upserted on
+external_id in its own transaction: one query finds the existing rows, new
+rows are inserted with bulk_create and existing ones updated with one
+UPDATE ... CASE statement per UPDATE_BATCH_SIZE rows. A row that fails
+validation is reported with its line number and doesn't stop the import.
+
+bulk_create() and update() send no post_save, so the imported external ids
+are dropped from this process' externalids cache after every batch.
+
+CSV files need a header row with the columns name, description and external_id.
+JSON Lines files have one object with the same keys per line.
+"""
+import codecs
+import csv
+import json
+import sys
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, Value, When
+
+from .externalids import forget_external_ids
+from .forms import MyPluginForm
+from .models import MyPluginModel
+
+PY2 = sys.version_info[0] == 2
+
+IMPORT_BATCH_SIZE = 1000
+# Rows per UPDATE statement
+UPDATE_BATCH_SIZE = 250
+# Max number of row errors kept in an ImportResult, all errors are counted
+MAX_REPORTED_ERRORS = 1000
+IMPORT_FIELDS = ('name', 'description', 'external_id')
+UPDATE_FIELDS = ('name', 'description')
+
+
+class ImportResult(object):
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.updated = 0
+        self.error_count = 0
+        # (line number, {field: [message, ...]}), at most MAX_REPORTED_ERRORS of them
+        self.errors = []
+
+    def add_error(self, line, errors):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, errors))
+
+    def as_dict(self):
+        return {
+            'rows': self.rows,
+            'created': self.created,
+            'updated': self.updated,
+            'error_count': self.error_count,
+            'errors': [{'line': line, 'errors': errors} for line, errors in self.errors],
+        }
+
+
+def parse_csv(fileobj):
+    """ (line number, row dict, parse error) for every row of a CSV file opened in binary mode
+    """
+    lines = fileobj if PY2 else codecs.iterdecode(fileobj, 'utf-8')
+    reader = csv.DictReader(lines)
+    for row in reader:
+        if PY2:
+            row = dict((key, value.decode('utf-8') if value is not None else None) for key, value in row.items())
+        yield reader.line_num, row, None
+
+
+def parse_jsonl(fileobj):
+    """ (line number, row dict, parse error) for every non-empty line of a JSON Lines file
+    """
+    for line_number, line in enumerate(fileobj, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line.decode('utf-8') if isinstance(line, bytes) else line)
+        except ValueError as e:
+            yield line_number, None, "Invalid JSON: %s" % e
+            continue
+        if not isinstance(row, dict):
+            yield line_number, None, "Expected a JSON object"
+            continue
+        yield line_number, row, None
+
+
+PARSERS = {
+    'csv': parse_csv,
+    'jsonl': parse_jsonl,
+}
+
+
+def clean_row(row):
+    """ Validate a row with the rules of MyPluginForm's fields and the model's fields.
+        Returns (cleaned values, None) or (None, {field: [message, ...]})
+    """
+    cleaned = {}
+    errors = {}
+    for name in IMPORT_FIELDS:
+        value = row.get(name)
+        try:
+            if name in MyPluginForm.base_fields:
+                value = MyPluginForm.base_fields[name].clean(value)
+            model_field = MyPluginModel._meta.get_field(name)
+            value = model_field.clean(value if value != '' or not model_field.null else None, None)
+        except ValidationError as e:
+            errors[name] = list(e.messages)
+            continue
+        cleaned[name] = value
+    if errors:
+        return None, errors
+    return cleaned, None
+
+
+def import_rows(rows, batch_size=IMPORT_BATCH_SIZE):
+    """ Import (line number, row dict, parse error) tuples, returns an ImportResult
+    """
+    result = ImportResult()
+    batch = OrderedDict()
+    for line, row, error in rows:
+        result.rows += 1
+        if error:
+            result.add_error(line, {'__all__': [error]})
+            continue
+        cleaned, errors = clean_row(row)
+        if errors:
+            result.add_error(line, errors)
+            continue
+        # A later row for the same external id replaces an earlier one
+        batch.pop(cleaned['external_id'], None)
+        batch[cleaned['external_id']] = cleaned
+        if len(batch) >= batch_size:
+            _upsert(batch, result)
+            batch = OrderedDict()
+    if batch:
+        _upsert(batch, result)
+    return result
+
+
+def import_file(fileobj, file_format, batch_size=IMPORT_BATCH_SIZE):
+    if file_format not in PARSERS:
+        raise ValueError("Unknown import format: %s" % file_format)
+    return import_rows(PARSERS[file_format](fileobj), batch_size)
+
+
+def _upsert(batch, result):
+    """ Insert or update a batch of cleaned rows, keyed by external id, in one transaction
+    """
+    with transaction.atomic():
+        existing = {}
+        for obj in MyPluginModel.objects.by_external_ids(list(batch)).order_by('pk'):
+            # If there are several rows with the same external id, the oldest one is updated
+            existing.setdefault(obj.external_id, obj)
+        to_create = []
+        to_update = []
+        for external_id, values in batch.items():
+            obj = existing.get(external_id)
+            if obj is None:
+                to_create.append(MyPluginModel(**values))
+                continue
+            for name in UPDATE_FIELDS:
+                setattr(obj, name, values[name])
+            to_update.append(obj)
+        if to_create:
+            MyPluginModel.objects.bulk_create(to_create, batch_size=len(to_create))
+        for start in range(0, len(to_update), UPDATE_BATCH_SIZE):
+            _update(to_update[start:start + UPDATE_BATCH_SIZE])
+    forget_external_ids(list(batch))
+    result.created += len(to_create)
+    result.updated += len(to_update)
+
+
+def _update(objs):
+    """ Save the UPDATE_FIELDS of the objects with a single UPDATE ... CASE statement.
+        Works the same as bulk_update(), which is only available in Django 2.2 and later.
+    """
+    values = {}
+    for name in UPDATE_FIELDS:
+        field = MyPluginModel._meta.get_field(name)
+        values[name] = Case(*[When(pk=obj.pk, then=Value(getattr(obj, name), output_field=field)) for obj in objs],
+                            output_field=field)
+    MyPluginModel.objects.filter(pk__in=[obj.pk for obj in objs]).update(**values)
@@ -14,5 +14,7 @@ sudo cp -r $DIR/* $PORTAL_ROOT/portal/plugins/$PLUGIN_NAME
 
 echo "Done."
 echo "Stop Portal: supervisorctl stop portal"
-echo "Sync the database: root@mediabox:/opt/cantemo/portal# python manage.py syncdb"
+echo "Migrate the database: root@mediabox:/opt/cantemo/portal# python manage.py migrate PortalPluginTemplate"
+echo "  If the plugin's tables were created with syncdb (before the plugin had migrations), migrate the first time with:"
+echo "  root@mediabox:/opt/cantemo/portal# python manage.py migrate PortalPluginTemplate --fake-initial"
 echo "Start Portal: supervisorctl start portal"
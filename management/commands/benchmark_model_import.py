@@ -0,0 +1,58 @@
+"""
+Benchmark of the MyPluginModel bulk import.
+
+    python manage.py benchmark_model_import [--rows 1000000] [--batch-size 1000] [--keep]
+
+Generates a CSV file with the given number of rows and imports it twice, the
+first pass creating every row and the second updating them. Everything is
+rolled back afterwards unless --keep is given.
+"""
+import csv
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from portal.plugins.PortalPluginTemplate.importer import IMPORT_BATCH_SIZE, import_file
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Time a bulk import of generated MyPluginModel rows"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000, help="Number of rows to import")
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help="Rows per transaction")
+        parser.add_argument('--keep', action='store_true', help="Keep the imported rows")
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        try:
+            with os.fdopen(fd, 'w') as fileobj:
+                writer = csv.writer(fileobj)
+                writer.writerow(['name', 'description', 'external_id'])
+                for number in range(rows):
+                    writer.writerow(['Benchmark row %d' % number, 'Imported by benchmark_model_import',
+                                     'BENCH-%d' % number])
+            try:
+                with transaction.atomic():
+                    for label in ('create', 'update'):
+                        started = time.time()
+                        with open(path, 'rb') as fileobj:
+                            result = import_file(fileobj, 'csv', options['batch_size'])
+                        seconds = time.time() - started
+                        self.stdout.write("%s: %d rows in %.1fs, %.0f rows/s (%d created, %d updated, %d errors)" % (
+                            label, result.rows, seconds, result.rows / seconds if seconds else 0,
+                            result.created, result.updated, result.error_count))
+                    if not options['keep']:
+                        raise _Rollback()
+            except _Rollback:
+                self.stdout.write("Rolled back the imported rows")
+        finally:
+            os.remove(path)
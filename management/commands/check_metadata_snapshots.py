@@ -0,0 +1,105 @@
+"""
+Check that consecutive metadata updates of an item are diffed against the snapshot cache.
+
+    python manage.py check_metadata_snapshots
+
+Runs PreMetadataUpdate on synthetic metadata documents, with the metadata
+fetches and revision reads answered locally: every save gives the item a new
+revision, as Vidispine does. Fails if an update after the first fetches the
+item's metadata instead of using the snapshot written through by the save
+before it. Doesn't talk to Vidispine, the snapshots are kept in the Django
+cache under a prefix of their own.
+"""
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from portal.plugins.PortalPluginTemplate.management.commands.benchmark_metadata_diff import build_document
+from portal.plugins.PortalPluginTemplate.snapshots import MetadataSnapshotCache, document_snapshot
+from portal.plugins.PortalPluginTemplate.vmysignallisteners import PreMetadataUpdate
+
+ITEM_ID = 'VX-0'
+DOCUMENT_SIZE = 100
+UPDATES = 5
+
+
+class _LocalPreMetadataUpdate(PreMetadataUpdate):
+    """ PreMetadataUpdate with the item's metadata and revision kept locally
+    """
+    def __init__(self, async_mode=False):
+        PreMetadataUpdate.__init__(self, async_mode)
+        self.snapshots = MetadataSnapshotCache(prefix='portalplugintemplate:checksnapshots')
+        self.revision = 1
+        # The threads which fetched the item's metadata
+        self.fetches = []
+
+    def _fetch_snapshot(self, instance, revision):
+        self.fetches.append(threading.current_thread())
+        return document_snapshot(build_document(DOCUMENT_SIZE), 'VX-%d' % self.revision)
+
+    def _fetch_revision(self, instance):
+        return 'VX-%d' % self.revision
+
+    def edit(self):
+        """ An update based on the current revision of the item, and its save
+        """
+        document = build_document(DOCUMENT_SIZE)
+        document.revision = 'VX-%d' % self.revision
+        self.receiver_itemmetadata_updated(ITEM_ID, method='setItemMetadata', metadata_document=document)
+        self.revision += 1
+        self.receiver_item_modified(ITEM_ID, method='setItemMetadata', metadata_document=document)
+        if self.executor is not None:
+            # Wait for the diff and the write-through, as the user takes a while before the next edit
+            while True:
+                stats = self.executor.stats()
+                if stats['completed'] + stats['failed'] + stats['rejected'] >= stats['submitted']:
+                    break
+                time.sleep(0.01)
+
+
+def check_write_through():
+    listener = _LocalPreMetadataUpdate()
+    for _number in range(UPDATES):
+        listener.edit()
+    yield "Only the first update fetches metadata", len(listener.fetches) == 1
+    yield "Later updates use the snapshot", listener.snapshots.hits == UPDATES - 1
+
+
+def check_other_revision():
+    listener = _LocalPreMetadataUpdate()
+    listener.edit()
+    # Changed outside Portal
+    listener.revision += 1
+    listener.edit()
+    yield "An update of another revision fetches metadata", len(listener.fetches) == 2
+
+
+def check_async():
+    listener = _LocalPreMetadataUpdate(async_mode=True)
+    try:
+        for _number in range(UPDATES):
+            listener.edit()
+    finally:
+        listener.executor.shutdown()
+    current = threading.current_thread()
+    yield "Async: only the first update fetches metadata", len(listener.fetches) == 1
+    yield "Async: no fetch in the handler once cached", listener.fetches.count(current) == 1
+    yield "Async: later updates use the snapshot", listener.snapshots.hits == UPDATES - 1
+
+
+CHECKS = (check_write_through, check_other_revision, check_async)
+
+
+class Command(BaseCommand):
+    help = "Check that consecutive metadata updates use the metadata snapshot cache"
+
+    def handle(self, *args, **options):
+        failed = 0
+        for check in CHECKS:
+            MetadataSnapshotCache(prefix='portalplugintemplate:checksnapshots').invalidate(ITEM_ID)
+            for name, ok in check():
+                self.stdout.write("%-50s %s" % (name, 'ok' if ok else 'FAILED'))
+                failed += not ok
+        if failed:
+            raise CommandError("%d checks failed" % failed)
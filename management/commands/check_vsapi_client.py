@@ -0,0 +1,117 @@
+"""
+Check the retries, keep-alive connections and circuit breaker of the Vidispine client against a local fake
+Vidispine server.
+
+    python manage.py check_vsapi_client
+
+Runs VSClient.request() against FakeVidispine with scripted responses and
+fails if the client doesn't retry, reuse connections, give up or fail fast as
+it should. Doesn't talk to the real Vidispine.
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from portal.plugins.PortalPluginTemplate.fakevidispine import FakeVidispine
+from portal.plugins.PortalPluginTemplate.vsclient import CircuitBreaker, CircuitOpenError, HTTPError, VSClient
+
+RESET_TIMEOUT = 0.1
+
+
+def _status(client, path, method='GET'):
+    """ The HTTP status of a request, or the name of the exception it raised
+    """
+    try:
+        response = client.request(path, method=method, runas='someuser')
+    except HTTPError as e:
+        return e.code
+    except CircuitOpenError:
+        return 'open'
+    response.read()
+    response.close()
+    return response.getcode()
+
+
+def check_retries(server, client):
+    server.respond('GET', 'item/VX-1', 503)
+    server.respond('GET', 'item/VX-1', 503)
+    server.respond('GET', 'item/VX-1', 200, '<ItemDocument id="VX-1"/>')
+    yield "GET retried after 5xx", _status(client, 'item/VX-1') == 200 and len(server.requests) == 3
+    request = server.requests[-1]
+    yield "Credentials and RunAs sent", (request['headers'].get('authorization', '').startswith('Basic ')
+                                         and request['headers'].get('runas') == 'someuser')
+
+
+def check_keep_alive(server, client):
+    server.respond('GET', 'item/VX-5', 200, '<ItemDocument id="VX-5"/>')
+    server.respond('GET', 'item/VX-6', 404)
+    statuses = [_status(client, 'item/VX-5'), _status(client, 'item/VX-6'), _status(client, 'item/VX-5')]
+    yield "Connection reused", (statuses == [200, 404, 200]
+                                and len(set(request['client'] for request in server.requests)) == 1)
+    response = client.request('item/VX-5')
+    yield "Second connection while a response is open", _status(client, 'item/VX-5') == 200
+    response.read()
+    response.close()
+    yield "Open response's connection not shared", len(set(request['client'] for request in server.requests)) == 2
+
+
+def check_no_retries(server, client):
+    server.respond('GET', 'item/VX-2', 404)
+    yield "4xx not retried", _status(client, 'item/VX-2') == 404 and len(server.requests) == 1
+    server.respond('POST', 'collection', 503)
+    yield "POST not retried", _status(client, 'collection', 'POST') == 503 and len(server.requests) == 2
+
+
+def check_breaker(server, client):
+    server.respond('GET', 'item/VX-3', 500)
+    _status(client, 'item/VX-3')
+    _status(client, 'item/VX-3')
+    requests = len(server.requests)
+    yield "Breaker opens after failures", client.breaker.state == CircuitBreaker.OPEN
+    yield "Open breaker fails fast", _status(client, 'item/VX-3') == 'open' and len(server.requests) == requests
+
+    time.sleep(RESET_TIMEOUT)
+    yield "Failed trial call opens the breaker again", (_status(client, 'item/VX-3') == 500
+                                                        and client.breaker.state == CircuitBreaker.OPEN)
+
+    time.sleep(RESET_TIMEOUT)
+    server.respond('GET', 'item/VX-4', 404)
+    yield "4xx trial call closes the breaker", (_status(client, 'item/VX-4') == 404
+                                                and client.breaker.state == CircuitBreaker.CLOSED)
+    server.respond('GET', 'item/VX-1', 200)
+    yield "Calls made after the trial", _status(client, 'item/VX-1') == 200
+
+
+def check_unreachable(server, client):
+    server.stop()
+    try:
+        client.request('item/VX-1')
+    except CircuitOpenError:
+        yield "Unreachable server fails", False
+    except (IOError, OSError):
+        yield "Unreachable server fails", client.breaker.failures == 1
+    else:
+        yield "Unreachable server fails", False
+
+
+CHECKS = (check_retries, check_keep_alive, check_no_retries, check_breaker, check_unreachable)
+
+
+class Command(BaseCommand):
+    help = "Run the Vidispine client against a local fake Vidispine server"
+
+    def handle(self, *args, **options):
+        failed = 0
+        for check in CHECKS:
+            server = FakeVidispine().start()
+            client = VSClient(timeout=5, retries=2, backoff=0.01, breaker=CircuitBreaker(2, RESET_TIMEOUT),
+                              base_url=server.base_url, username='admin', password='admin')
+            try:
+                for name, ok in check(server, client):
+                    self.stdout.write("%-45s %s" % (name, 'ok' if ok else 'FAILED'))
+                    failed += not ok
+            finally:
+                if check is not check_unreachable:
+                    server.stop()
+        if failed:
+            raise CommandError("%d checks failed" % failed)
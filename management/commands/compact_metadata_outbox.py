@@ -0,0 +1,22 @@
+"""
+Remove old metadata change events from the outbox.
+
+    python manage.py compact_metadata_outbox [--days 30]
+"""
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from portal.plugins.PortalPluginTemplate.outbox import compact_events
+
+
+class Command(BaseCommand):
+    help = "Delete metadata change events older than the given number of days"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30, help="Keep events from this many days")
+
+    def handle(self, *args, **options):
+        deleted = compact_events(timezone.now() - timedelta(days=options['days']))
+        self.stdout.write("Deleted %d metadata change events" % deleted)
@@ -0,0 +1,33 @@
+"""
+Bulk import MyPluginModels from a CSV or JSON Lines file, upserting on external_id.
+
+    python manage.py import_my_plugin_models rows.csv [--format csv|jsonl] [--batch-size 1000]
+"""
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from portal.plugins.PortalPluginTemplate.importer import IMPORT_BATCH_SIZE, PARSERS, import_file
+
+
+class Command(BaseCommand):
+    help = "Import MyPluginModels from a CSV or JSON Lines file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import")
+        parser.add_argument('--format', choices=sorted(PARSERS),
+                            help="File format, by default taken from the file extension")
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help="Rows per transaction")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+        if file_format not in PARSERS:
+            raise CommandError("Unknown file format '%s', use --format" % file_format)
+        with open(path, 'rb') as fileobj:
+            result = import_file(fileobj, file_format, options['batch_size'])
+        for line, errors in result.errors:
+            self.stderr.write("Line %d: %s" % (line, json.dumps(errors)))
+        self.stdout.write("%d rows: %d created, %d updated, %d errors" % (
+            result.rows, result.created, result.updated, result.error_count))
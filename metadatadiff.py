@@ -0,0 +1,350 @@
+"""
+Diffing of item metadata.
+
+Both sides of a diff are indexed once into {field name: [value, ...]}, so
+comparing a document is linear in the number of fields no matter how large
+the metadata schema is. Fields inside field groups are indexed by their
+field name, with the values of all instances of the group collected in
+document order, and the group they belong to is kept for reporting.
+
+Only the fields present in the new document are compared, as a metadata
+update leaves fields it doesn't mention untouched.
+
+Time based metadata (every timespan other than -INF -> +INF) is diffed span
+by span. Vidispine merges an update into the span with the same interval,
+and the same rule applies: the fields the update gives for a span are
+changed, the rest of the span and spans at other intervals are left alone.
+So only spans at an interval the update mentions are compared, and a span is
+removed only when the update clears all of its values. A span at a new
+interval was added, unless a span with the same content (moved) or an
+overlapping one (changed and retimed) was removed by the same update. Spans
+are matched through indexes on their interval and content rather than
+compared pairwise, so large annotation sets diff in O(n log n).
+"""
+from collections import Counter, defaultdict, deque
+from fractions import Fraction
+
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+MOVED = 'moved'
+
+# Vidispine time bases which are given by name, in samples per second
+NAMED_TIME_BASES = {
+    'PAL': Fraction(25),
+    'NTSC': Fraction(30000, 1001),
+    'NTSC30': Fraction(30),
+}
+
+
+class MetadataIndex(object):
+    """ Field values of a metadata document, indexed by field name
+    """
+    def __init__(self, values=None, groups=None):
+        # field name -> [value, ...]
+        self.values = values if values is not None else {}
+        # field name -> name of the field group it is in, for fields in groups
+        self.groups = groups if groups is not None else {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, name):
+        return name in self.values
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def _add_fields(self, fields, group_name=None):
+        for field in fields:
+            self.values.setdefault(field.name, []).extend(v.value() for v in field.value_)
+            if group_name:
+                self.groups[field.name] = group_name
+
+    def _add_groups(self, groups):
+        for group in groups:
+            self._add_fields(group.field, group.name)
+            self._add_groups(group.group)
+
+
+def index_document(metadata_document):
+    """ Index the -INF -> +INF timespan of a Vidispine metadata document, time based metadata is skipped
+    """
+    index = MetadataIndex()
+    for ts in metadata_document.timespan:
+        if ts.start == '-INF' and ts.end == '+INF':
+            index._add_fields(ts.field)
+            index._add_groups(ts.group)
+            break
+    return index
+
+
+class FieldChange(object):
+    """ A single field that is about to change
+    """
+    def __init__(self, name, old_values, new_values, group=None):
+        self.name = name
+        self.old_values = old_values
+        self.new_values = new_values
+        self.group = group
+        old_counts = Counter(old_values)
+        new_counts = Counter(new_values)
+        self.added_values = list((new_counts - old_counts).elements())
+        self.removed_values = list((old_counts - new_counts).elements())
+        if not old_values:
+            self.kind = ADDED
+        elif not new_values:
+            self.kind = REMOVED
+        else:
+            self.kind = CHANGED
+
+    def __repr__(self):
+        return '<FieldChange %s %s: %r -> %r>' % (self.kind, self.name, self.old_values, self.new_values)
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'group': self.group,
+            'kind': self.kind,
+            'old_values': self.old_values,
+            'new_values': self.new_values,
+            'added_values': self.added_values,
+            'removed_values': self.removed_values,
+        }
+
+
+class TimespanChange(object):
+    """ A time based metadata span that is about to be added, removed, moved or changed
+    """
+    def __init__(self, kind, old_span=None, new_span=None, field_changes=None):
+        self.kind = kind
+        self.old_span = old_span
+        self.new_span = new_span
+        self.field_changes = field_changes if field_changes is not None else []
+        if kind == CHANGED and field_changes is None:
+            self.field_changes = _diff_field_maps(old_span.values, new_span.values)
+
+    def __repr__(self):
+        return '<TimespanChange %s %r -> %r>' % (self.kind, self.old_span, self.new_span)
+
+    def as_dict(self):
+        return {
+            'kind': self.kind,
+            'old': self.old_span.as_dict() if self.old_span else None,
+            'new': self.new_span.as_dict() if self.new_span else None,
+            'field_changes': [change.as_dict() for change in self.field_changes],
+        }
+
+
+class MetadataChangeSet(object):
+    """ The fields and time based metadata spans of an item that are about to change.
+        Iterating over it gives the field changes of the -INF -> +INF timespan.
+    """
+    def __init__(self, item_id, changes=None, timespan_changes=None):
+        self.item_id = item_id
+        self.changes = changes if changes is not None else []
+        self.timespan_changes = timespan_changes if timespan_changes is not None else []
+
+    def __iter__(self):
+        return iter(self.changes)
+
+    def __len__(self):
+        return len(self.changes) + len(self.timespan_changes)
+
+    def __bool__(self):
+        return bool(self.changes or self.timespan_changes)
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return '<MetadataChangeSet %s: %d changes, %d timespan changes>' % (
+            self.item_id, len(self.changes), len(self.timespan_changes))
+
+    def field_names(self):
+        return [change.name for change in self.changes]
+
+    def as_dict(self):
+        return {
+            'item_id': self.item_id,
+            'changes': [change.as_dict() for change in self.changes],
+            'timespan_changes': [change.as_dict() for change in self.timespan_changes],
+        }
+
+
+def _non_empty(values):
+    # Empty form fields are submitted as empty values, which is the same as no value
+    return [v for v in values if v is not None and v != '']
+
+
+def diff_values(item_id, old_values, new_index):
+    """ Compare current field values, {field name: [value, ...]}, with an indexed new document.
+        Multi-value fields are compared regardless of value order.
+    """
+    changes = []
+    for name, new_values in new_index.values.items():
+        old = _non_empty(old_values.get(name) or [])
+        new = _non_empty(new_values)
+        if len(old) == len(new) and Counter(old) == Counter(new):
+            continue
+        changes.append(FieldChange(name, old, new, new_index.groups.get(name)))
+    changes.sort(key=lambda change: change.name)
+    return MetadataChangeSet(item_id, changes)
+
+
+def _diff_field_maps(old_values, new_values):
+    """ Field changes between two {field name: [value, ...]} maps, including fields only in one of them
+    """
+    changes = []
+    for name in sorted(set(old_values) | set(new_values)):
+        old = _non_empty(old_values.get(name) or [])
+        new = _non_empty(new_values.get(name) or [])
+        if len(old) != len(new) or Counter(old) != Counter(new):
+            changes.append(FieldChange(name, old, new))
+    return changes
+
+
+def parse_timecode(timecode):
+    """ Seconds, as a Fraction, of a Vidispine time code such as "1500@PAL", "48000@48000",
+        "1@30000:1001" or "12.5"
+    """
+    if '@' not in timecode:
+        return Fraction(timecode)
+    samples, time_base = timecode.split('@', 1)
+    if time_base in NAMED_TIME_BASES:
+        rate = NAMED_TIME_BASES[time_base]
+    elif ':' in time_base:
+        numerator, denominator = time_base.split(':', 1)
+        rate = Fraction(int(numerator), int(denominator))
+    else:
+        rate = Fraction(time_base)
+    return Fraction(int(samples)) / rate
+
+
+def document_timespans(metadata_document):
+    """ The time based timespans of a Vidispine metadata document, as plain
+        (start time code, end time code, {field name: [value, ...]}) tuples
+    """
+    spans = []
+    for ts in metadata_document.timespan:
+        if ts.start == '-INF' and ts.end == '+INF':
+            continue
+        index = MetadataIndex()
+        index._add_fields(ts.field)
+        index._add_groups(ts.group)
+        spans.append((ts.start, ts.end, index.values))
+    return spans
+
+
+def has_timespans(metadata_document):
+    """ Whether a Vidispine metadata document has time based metadata, without indexing it
+    """
+    return any(not (ts.start == '-INF' and ts.end == '+INF') for ts in metadata_document.timespan)
+
+
+class Span(object):
+    """ A time based metadata span, with parsed start and end times and a hashable
+        representation of its content for matching
+    """
+    __slots__ = ('start_tc', 'end_tc', 'start', 'end', 'values', 'content')
+
+    def __init__(self, start_tc, end_tc, values):
+        self.start_tc = start_tc
+        self.end_tc = end_tc
+        self.start = parse_timecode(start_tc)
+        self.end = parse_timecode(end_tc)
+        self.values = values
+        self.content = tuple(sorted(
+            (name, tuple(sorted(_non_empty(field_values)))) for name, field_values in values.items()
+            if _non_empty(field_values)))
+
+    def __repr__(self):
+        return '<Span %s-%s>' % (self.start_tc, self.end_tc)
+
+    def overlaps(self, other):
+        return max(self.start, other.start) < min(self.end, other.end)
+
+    def as_dict(self):
+        return {'start': self.start_tc, 'end': self.end_tc, 'values': self.values}
+
+
+def _by_start(span):
+    return span.start, span.end
+
+
+def diff_timespans(old_spans, new_spans):
+    """ Compare the time based spans of an item with the spans of an update to it, both lists of
+        document_timespans() tuples. Returns a list of TimespanChange.
+    """
+    old_by_interval = defaultdict(list)
+    for span in old_spans:
+        span = Span(*span)
+        old_by_interval[(span.start, span.end)].append(span)
+    changes = []
+    removed, added = [], []
+
+    # Merge the new spans into the spans with the same interval
+    for span in (Span(*span) for span in new_spans):
+        candidates = old_by_interval.get((span.start, span.end))
+        if not candidates:
+            if span.content:
+                added.append(span)
+            continue
+        old_span = candidates.pop()
+        merged = dict(old_span.values)
+        merged.update(span.values)
+        if not any(_non_empty(values) for values in merged.values()):
+            removed.append(old_span)
+            continue
+        mentioned = dict((name, old_span.values.get(name) or []) for name in span.values)
+        field_changes = _diff_field_maps(mentioned, span.values)
+        if field_changes:
+            changes.append(TimespanChange(CHANGED, old_span, span, field_changes))
+
+    # Same content, different interval. Pairing in start order keeps the total distance moved minimal.
+    by_content = defaultdict(list)
+    for span in removed:
+        by_content[span.content].append(span)
+    new_by_content = defaultdict(list)
+    for span in added:
+        new_by_content[span.content].append(span)
+    remaining_old, remaining_new = [], []
+    for content, new_candidates in new_by_content.items():
+        old_candidates = sorted(by_content.pop(content, []), key=_by_start)
+        new_candidates.sort(key=_by_start)
+        paired = min(len(old_candidates), len(new_candidates))
+        for old_span, new_span in zip(old_candidates, new_candidates):
+            changes.append(TimespanChange(MOVED, old_span, new_span))
+        remaining_old.extend(old_candidates[paired:])
+        remaining_new.extend(new_candidates[paired:])
+    for spans in by_content.values():
+        remaining_old.extend(spans)
+
+    # Overlapping spans with different content, swept in start order
+    remaining_old.sort(key=_by_start)
+    remaining_new.sort(key=_by_start)
+    active = deque()
+    position = 0
+    added = []
+    for span in remaining_new:
+        while position < len(remaining_old) and remaining_old[position].start < span.end:
+            active.append(remaining_old[position])
+            position += 1
+        # Spans ending before this one starts can't overlap any later span either
+        while active and active[0].end <= span.start:
+            changes.append(TimespanChange(REMOVED, old_span=active.popleft()))
+        match = None
+        for candidate in active:
+            if candidate.overlaps(span):
+                match = candidate
+                break
+        if match is None:
+            added.append(span)
+        else:
+            active.remove(match)
+            changes.append(TimespanChange(CHANGED, match, span))
+    for span in list(active) + remaining_old[position:]:
+        changes.append(TimespanChange(REMOVED, old_span=span))
+    for span in added:
+        changes.append(TimespanChange(ADDED, new_span=span))
+
+    changes.sort(key=lambda change: _by_start(change.new_span or change.old_span))
+    return changes
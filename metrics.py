@@ -0,0 +1,276 @@
+"""
+Lightweight in-process metrics, rendered in the Prometheus text format.
+
+    CALLS = counter('portalplugintemplate_calls_total', "Calls made", ['function'])
+    SECONDS = histogram('portalplugintemplate_call_seconds', "Time spent in calls", ['function'])
+
+    CALLS.inc('getItem')
+    with SECONDS.time('getItem'):
+        ...
+
+    @SECONDS.time('getItem')
+    def get_item(...):
+        ...
+
+    gauge('portalplugintemplate_pending_items', "Items waiting", lambda: len(items))
+
+Counters and histograms are updated under a lock of their own, which is held
+for a dict lookup and a few additions, so instrumenting a hot path costs a
+few microseconds. Gauges are callables which are only evaluated when the
+metrics are rendered.
+
+Metrics are per process. With several Portal processes, every process
+serves its own numbers from the metrics endpoint.
+"""
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(int(value))
+    return repr(value)
+
+
+class _Timer(object):
+    """ Observes the time spent in a with block or decorated function into a histogram
+    """
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+        self._local = threading.local()
+
+    def __enter__(self):
+        starts = getattr(self._local, 'starts', None)
+        if starts is None:
+            starts = self._local.starts = []
+        # A stack, so the same timer can be nested and used from several threads
+        starts.append(time.time())
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.histogram.observe(time.time() - self._local.starts.pop(), *self.labelvalues)
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.histogram.observe(time.time() - start, *self.labelvalues)
+        return wrapper
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _check(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError("%s takes the labels %s" % (self.name, ', '.join(self.labelnames)))
+
+    def render(self):
+        # Every metric type has samples(): (name suffix, label values, extra label or None, value) tuples
+        lines = ['# HELP %s %s' % (self.name, self.documentation.replace('\n', ' ')),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for suffix, labelvalues, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, _format_labels(self.labelnames, labelvalues, extra),
+                                        _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """ A count which only goes up, by convention named ..._total
+    """
+    type = 'counter'
+
+    def inc(self, *labelvalues, **kwargs):
+        """ Add `amount` (1 by default) to the counter of the label values
+        """
+        self._check(labelvalues)
+        amount = kwargs.get('amount', 1)
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        return self._values.get(labelvalues, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [('', labelvalues, None, value) for labelvalues, value in values]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        self._check(labelvalues)
+        # The first bucket whose upper bound the value is within, len(buckets) for +Inf
+        position = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labelvalues)
+            if entry is None:
+                # [counts per bucket (not cumulative) + the +Inf bucket, sum]
+                entry = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][position] += 1
+            entry[1] += value
+
+    def time(self, *labelvalues):
+        """ A context manager and decorator observing the time spent in it
+        """
+        self._check(labelvalues)
+        return _Timer(self, labelvalues)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labelvalues, (list(counts), total)) for labelvalues, (counts, total)
+                            in self._values.items())
+        samples = []
+        for labelvalues, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', labelvalues, ('le', _format_value(float(bound))), cumulative))
+            samples.append(('_sum', labelvalues, None, total))
+            samples.append(('_count', labelvalues, None, cumulative))
+        return samples
+
+
+class Gauge(Metric):
+    """ A value computed when the metrics are rendered. `func` returns a number, or
+        for a gauge with labels a {label values tuple: number} dict.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, documentation, func, labelnames=()):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.func = func
+
+    def samples(self):
+        value = self.func()
+        if value is None:
+            return []
+        if not self.labelnames:
+            return [('', (), None, value)]
+        return [('', labelvalues, None, v) for labelvalues, v in sorted(value.items())]
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """ Add a metric, or return the one already registered under its name. Modules
+            may be imported more than once (e.g. through different import paths), which
+            must not lose the counts made through the first import.
+        """
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError("A different metric is already registered as %s" % metric.name)
+                if isinstance(metric, Gauge):
+                    # The latest instance wins, e.g. when a listener has been re-created
+                    existing.func = metric.func
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def unregister(self, name):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        blocks = []
+        for metric in metrics:
+            try:
+                blocks.append(metric.render())
+            except Exception:
+                # A broken gauge shouldn't take the other metrics down with it
+                log.exception("Failed rendering metric %s" % metric.name)
+        return '\n'.join(blocks) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def gauge(name, documentation, func, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, func, labelnames))
+
+
+# Shared by the views of the plugin
+VIEW_SECONDS = histogram('portalplugintemplate_view_seconds', "Time spent in plugin views", ['view'])
+VIEW_ERRORS = counter('portalplugintemplate_view_errors_total', "Plugin views which raised an exception",
+                      ['view'])
+
+
+def instrument_view(view_class):
+    """ Class decorator for ClassViews, times every call of the view labelled with the class name
+    """
+    call = view_class.__call__
+    name = view_class.__name__
+
+    @functools.wraps(call)
+    def __call__(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return call(self, *args, **kwargs)
+        except Exception:
+            VIEW_ERRORS.inc(name)
+            raise
+        finally:
+            VIEW_SECONDS.observe(time.time() - start, name)
+    view_class.__call__ = __call__
+    return view_class
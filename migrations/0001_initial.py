@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MyPluginModel',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=255, verbose_name='Name')),
+                ('description', models.TextField(null=True, verbose_name='Description', blank=True)),
+                ('external_id', models.CharField(max_length=64, verbose_name='External ID')),
+            ],
+            options={
+                'verbose_name': 'My Plugin Model',
+                'verbose_name_plural': 'My Plugin Model',
+            },
+        ),
+    ]
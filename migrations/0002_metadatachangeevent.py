@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('PortalPluginTemplate', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetadataChangeEvent',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('item_id', models.CharField(max_length=64, verbose_name='Item ID', db_index=True)),
+                ('kind', models.CharField(max_length=16, verbose_name='Kind')),
+                ('field_name', models.CharField(max_length=255, verbose_name='Field name', blank=True)),
+                ('start', models.CharField(max_length=64, verbose_name='Start', blank=True)),
+                ('end', models.CharField(max_length=64, verbose_name='End', blank=True)),
+                ('old_value', models.TextField(verbose_name='Old value', blank=True)),
+                ('new_value', models.TextField(verbose_name='New value', blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created', db_index=True)),
+            ],
+            options={
+                'ordering': ('id',),
+                'verbose_name': 'Metadata change event',
+                'verbose_name_plural': 'Metadata change events',
+            },
+        ),
+    ]
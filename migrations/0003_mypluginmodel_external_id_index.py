@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('PortalPluginTemplate', '0002_metadatachangeevent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mypluginmodel',
+            name='external_id',
+            field=models.CharField(max_length=64, verbose_name='External ID', db_index=True),
+        ),
+    ]
@@ -19,17 +19,36 @@ plugin is included in the APPS_TO_INSTALL list in settings.py.
 Example: 
 APPS_TO_INSTALL = [ ..., 'portal.plugins.PortalPluginTemplate', ... ]
 
-Don't forget to do a 'python manage.py syncdb' afterwards!
+Don't forget to do a 'python manage.py migrate PortalPluginTemplate' afterwards!
+If the tables were created with syncdb before the plugin had migrations, use
+'python manage.py migrate PortalPluginTemplate --fake-initial' the first time.
+0001_initial only creates the MyPluginModel table of those installs, so it is
+faked, and the later migrations add the rest.
 '''
 
 
+class MyPluginModelQuerySet(models.QuerySet):
+    def by_external_ids(self, external_ids):
+        return self.filter(external_id__in=external_ids)
+
+    def search(self, term):
+        """ Rows where the name or description contains the term, all rows for an empty term
+        """
+        if not term:
+            return self
+        return self.filter(models.Q(name__icontains=term) | models.Q(description__icontains=term))
+
+
 class MyPluginModel(models.Model):
     """ Definition of a plugin model.
         
     """
     name = models.CharField(_("Name"), max_length=255, blank=False, null=False)
     description = models.TextField(_("Description"), blank=True, null=True)
-    external_id = models.CharField(_("External ID"), max_length=64, blank=False, null=False)
+    # Not unique, MyPluginForm doesn't set it so rows added in the UI all have an empty external id
+    external_id = models.CharField(_("External ID"), max_length=64, blank=False, null=False, db_index=True)
+
+    objects = MyPluginModelQuerySet.as_manager()
     
     class Meta:
         verbose_name = _("My Plugin Model")
@@ -38,3 +57,39 @@ class MyPluginModel(models.Model):
     def __unicode__(self):
         _name = self.name + " (" + self.external_id + ")"
         return _name
+
+
+class MetadataChangeEvent(models.Model):
+    """ A metadata change made to an item, see outbox.py.
+        Field changes have a field name, time based span changes have a start and end instead.
+        Old and new values are JSON.
+    """
+    item_id = models.CharField(_("Item ID"), max_length=64, db_index=True)
+    kind = models.CharField(_("Kind"), max_length=16)
+    field_name = models.CharField(_("Field name"), max_length=255, blank=True)
+    start = models.CharField(_("Start"), max_length=64, blank=True)
+    end = models.CharField(_("End"), max_length=64, blank=True)
+    old_value = models.TextField(_("Old value"), blank=True)
+    new_value = models.TextField(_("New value"), blank=True)
+    created = models.DateTimeField(_("Created"), auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ('id',)
+        verbose_name = _("Metadata change event")
+        verbose_name_plural = _("Metadata change events")
+
+    def __unicode__(self):
+        return "%s %s %s" % (self.item_id, self.kind, self.field_name or "%s-%s" % (self.start, self.end))
+
+
+# Keep the external id lookup cache up to date
+from django.db.models.signals import post_delete, post_save, pre_save
+from .externalids import receiver_mypluginmodel_changed, receiver_mypluginmodel_saving
+pre_save.connect(receiver_mypluginmodel_saving, sender=MyPluginModel)
+post_save.connect(receiver_mypluginmodel_changed, sender=MyPluginModel)
+post_delete.connect(receiver_mypluginmodel_changed, sender=MyPluginModel)
+
+# Write metadata changes found by PreMetadataUpdate to the outbox once they are saved
+from .outbox import receiver_metadata_changed
+from .signals import item_metadata_changed
+item_metadata_changed.connect(receiver_metadata_changed)
@@ -0,0 +1,119 @@
+"""
+Outbox of item metadata changes.
+
+PreMetadataUpdate sends the changes of an update with the
+item_metadata_changed signal once vidispine_post_modify confirms the update
+was saved, and they are stored here as MetadataChangeEvent rows, for audit
+and for downstream systems to consume. Updates that fail to save leave no
+events. All events of an update are written with a single bulk_create.
+
+Consumers keep track of the id of the last event they have processed and
+read the events after it in id order:
+
+    last_id = 0
+    for event in iter_events(after_id=last_id):
+        ...
+        last_id = event.id
+
+Ids are handed out when a row is inserted, not when it is committed, so an
+event with a lower id can become visible after one with a higher id. A
+consumer that had moved past it would skip it for good. So only events
+created more than OUTBOX_SETTLE_SECONDS ago are read, by when the
+transactions that wrote them are expected to be committed, and the id order
+of what is read doesn't change any more. Consumers see events that much
+later, and clocks of the Portal servers must agree to well within it.
+
+Old events are removed with compact_events(), e.g. from the
+compact_metadata_outbox management command.
+"""
+import json
+import logging
+from datetime import timedelta
+
+from django.utils import timezone
+
+from .models import MetadataChangeEvent
+
+log = logging.getLogger(__name__)
+
+# Rows per INSERT statement
+OUTBOX_BATCH_SIZE = 500
+# Default number of events per page for consumers
+OUTBOX_PAGE_SIZE = 500
+# Rows per DELETE statement when compacting
+COMPACT_CHUNK_SIZE = 10000
+# Seconds before an event is read by consumers, longer than any transaction writing events
+OUTBOX_SETTLE_SECONDS = 60
+
+
+def changeset_events(changeset):
+    """ Unsaved MetadataChangeEvents for a metadatadiff.MetadataChangeSet
+    """
+    events = []
+    for change in changeset:
+        events.append(MetadataChangeEvent(
+            item_id=changeset.item_id, kind=change.kind, field_name=change.name,
+            old_value=json.dumps(change.old_values), new_value=json.dumps(change.new_values)))
+    for change in changeset.timespan_changes:
+        span = change.new_span or change.old_span
+        events.append(MetadataChangeEvent(
+            item_id=changeset.item_id, kind=change.kind, start=span.start_tc, end=span.end_tc,
+            old_value=json.dumps(change.old_span.as_dict()) if change.old_span else '',
+            new_value=json.dumps(change.new_span.as_dict()) if change.new_span else ''))
+    return events
+
+
+def record_changeset(changeset):
+    """ Store the changes of a MetadataChangeSet, returns the number of events written
+    """
+    events = changeset_events(changeset)
+    if events:
+        MetadataChangeEvent.objects.bulk_create(events, batch_size=OUTBOX_BATCH_SIZE)
+    return len(events)
+
+
+def receiver_metadata_changed(sender, instance, changeset, **kwargs):
+    """ The subscriber function to the item_metadata_changed signal
+    """
+    try:
+        count = record_changeset(changeset)
+    except Exception:
+        log.exception("Failed writing metadata changes of %s to the outbox" % instance)
+        return
+    log.debug("Wrote %d metadata change events of %s to the outbox" % (count, instance))
+
+
+def read_events(after_id=0, limit=OUTBOX_PAGE_SIZE, item_id=None, settle=OUTBOX_SETTLE_SECONDS):
+    """ One page of settled events with an id greater than after_id, in id order
+    """
+    settled = timezone.now() - timedelta(seconds=settle)
+    events = MetadataChangeEvent.objects.filter(id__gt=after_id, created__lt=settled)
+    if item_id is not None:
+        events = events.filter(item_id=item_id)
+    return list(events.order_by('id')[:limit])
+
+
+def iter_events(after_id=0, page_size=OUTBOX_PAGE_SIZE, item_id=None, settle=OUTBOX_SETTLE_SECONDS):
+    """ All settled events with an id greater than after_id, in id order, read a page at a time
+    """
+    while True:
+        page = read_events(after_id, page_size, item_id, settle)
+        for event in page:
+            yield event
+        if len(page) < page_size:
+            return
+        after_id = page[-1].id
+
+
+def compact_events(before, chunk_size=COMPACT_CHUNK_SIZE):
+    """ Delete events created before the given datetime, a chunk at a time so no single
+        statement locks a large part of the table. Returns the number of events deleted.
+    """
+    deleted = 0
+    while True:
+        ids = list(MetadataChangeEvent.objects.filter(created__lt=before)
+                   .order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+        MetadataChangeEvent.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
@@ -0,0 +1,146 @@
+"""
+Bundles of the JavaScript that plugins contribute to a pluginblock.
+
+Instead of every plugin returning its JavaScript inline on every page view,
+the plugins of a pluginblock add their code with add_to_bundle() when they
+are created. The code of a block is combined into one minified bundle, named
+by a hash of its content, which browsers can cache for good: a changed
+bundle gets a new name. return_string() then only emits a small reference
+to the bundle, and only for the first plugin of the block.
+
+Two kinds of blocks are supported:
+
+* Blocks rendered as HTML (AnnotationViewJS): the code is plain JavaScript
+  without <script> tags, and the reference is a <script src=...> tag.
+* Blocks spliced into inline JavaScript with a `playerOptions` variable in
+  scope (MediaViewVideoPlayerOptionsJS): the code is a list of statements
+  which modify playerOptions. The bundle wraps them in a function, which the
+  reference calls with playerOptions.
+
+The options reference runs in the middle of the player setup, which needs
+the changed playerOptions right away, so it can't wait for a script to load.
+The bundle is therefore loaded ahead, with a deferred <script src=...> in an
+HTML block of the same page (PRELOAD_BLOCKS), which doesn't hold up parsing
+or rendering the page. Deferred scripts run before the document is ready,
+so a player set up from then on finds the bundle loaded. Only if it isn't,
+on a page without the preload block or with a player set up earlier, the
+reference falls back to loading it with a synchronous request. That blocks
+the page until the bundle is loaded, which is from the browser cache after
+the first time, and browsers warn about synchronous requests; without it
+the first player of such a page would miss the options.
+"""
+import hashlib
+import threading
+
+# Blocks whose plugins return inline JavaScript working on playerOptions
+PLAYER_OPTIONS_BLOCKS = ('MediaViewVideoPlayerOptionsJS',)
+# HTML blocks rendered on the same pages as a player options block, which load its bundle ahead
+PRELOAD_BLOCKS = {'MediaViewVideoPlayerOptionsJS': 'MediaViewDropdown'}
+# Name of the global object bundles register their functions in
+BUNDLE_NAMESPACE = 'portalPluginTemplateBundles'
+
+_contributions = {}
+_bundles = {}
+_lock = threading.Lock()
+
+
+def add_to_bundle(block, plugin_guid, code):
+    """ Add the code of a plugin to the bundle of a block, in the order the plugins are created.
+        The code may be a callable returning the code, which is called when the bundle is built,
+        e.g. for code with URLs that can only be reversed once the URLconf is loaded.
+    """
+    with _lock:
+        contributions = _contributions.setdefault(block, [])
+        if plugin_guid not in [guid for guid, _code in contributions]:
+            contributions.append((plugin_guid, code))
+        _bundles.pop(block, None)
+
+
+def is_first_contributor(block, plugin_guid):
+    contributions = _contributions.get(block)
+    return bool(contributions) and contributions[0][0] == plugin_guid
+
+
+def minify(code):
+    """ Strip comments, indentation and blank lines from JavaScript. Line breaks are kept, so
+        automatic semicolon insertion works as before. Regular expression literals containing
+        // or /* are not supported.
+    """
+    out = []
+    position = 0
+    length = len(code)
+    quote = None
+    while position < length:
+        char = code[position]
+        if quote:
+            out.append(char)
+            if char == '\\' and position + 1 < length:
+                out.append(code[position + 1])
+                position += 1
+            elif char == quote:
+                quote = None
+        elif char in '"\'`':
+            quote = char
+            out.append(char)
+        elif code.startswith('//', position):
+            end = code.find('\n', position)
+            position = length if end == -1 else end
+            continue
+        elif code.startswith('/*', position):
+            end = code.find('*/', position + 2)
+            position = length if end == -1 else end + 2
+            continue
+        else:
+            out.append(char)
+        position += 1
+    lines = (line.strip() for line in ''.join(out).splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+def _build(block):
+    codes = [code() if callable(code) else code for _guid, code in _contributions.get(block, [])]
+    if block in PLAYER_OPTIONS_BLOCKS:
+        # Each plugin in a block of its own, as they were separate snippets
+        body = '\n'.join('{\n%s\n}' % code for code in codes)
+        source = ('window.%(ns)s = window.%(ns)s || {};\n'
+                  'window.%(ns)s.%(block)s = function(playerOptions) {\n%(body)s\nreturn playerOptions;\n};\n'
+                  % {'ns': BUNDLE_NAMESPACE, 'block': block, 'body': body})
+    else:
+        source = '\n;\n'.join(codes)
+    content = minify(source) + '\n'
+    digest = hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
+    return digest, content
+
+
+def get_bundle(block):
+    """ (content hash, minified JavaScript) of a block, None if no plugin contributes to it
+    """
+    bundle = _bundles.get(block)
+    if bundle is None:
+        with _lock:
+            if block not in _contributions:
+                return None
+            bundle = _bundles[block] = _build(block)
+    return bundle
+
+
+def bundle_reference(block, url):
+    """ What the first plugin of a block returns instead of its code, `url` being the bundle's URL
+    """
+    if block in PLAYER_OPTIONS_BLOCKS:
+        return ('if (!(window.%(ns)s && window.%(ns)s.%(block)s)) {\n'
+                '    // Not preloaded, see playerbundles.py\n'
+                '    $.ajax({url: "%(url)s", dataType: "script", async: false, cache: true});\n'
+                '}\n'
+                '// Leave the player options as they are if the bundle could not be loaded\n'
+                'if (window.%(ns)s && window.%(ns)s.%(block)s) {\n'
+                '    window.%(ns)s.%(block)s(playerOptions);\n'
+                '}\n'
+                % {'ns': BUNDLE_NAMESPACE, 'block': block, 'url': url})
+    return '<script src="%s"></script>' % url
+
+
+def preload_reference(url):
+    """ What the preload block of a player options block returns, `url` being the bundle's URL
+    """
+    return '<script src="%s" defer></script>' % url
@@ -0,0 +1,12 @@
+"""
+Signals sent by the plugin, for other code to consume.
+"""
+from django.dispatch import Signal
+
+# Sent before an item's metadata is updated, with the fields that are about to change.
+# Arguments: instance (the item id), changeset (a metadatadiff.MetadataChangeSet)
+item_metadata_changing = Signal()
+
+# Sent after an item's metadata update has been saved, with the changes it made.
+# Arguments: instance (the item id), changeset (a metadatadiff.MetadataChangeSet)
+item_metadata_changed = Signal()
@@ -0,0 +1,151 @@
+"""
+Cache of item metadata snapshots, used to diff a metadata update against the
+current item metadata without fetching the item from Vidispine every time.
+
+A snapshot is a plain dict, so it can be shared between processes through the
+Django cache:
+
+    {'revision': <metadata revision or None>,
+     'fields': {<field name>: [<value>, ...]},
+     'complete': True if 'fields' has every field of the item,
+     'timespans': [(<start>, <end>, {<field name>: [<value>, ...]}), ...] or None if not known}
+
+Snapshots are made from the item's metadata document, which is indexed once
+for all of its fields, so a field missing from a complete snapshot has no
+value.
+
+Snapshots are only kept in the Django cache, so a snapshot written through
+after an update in one process is what every process diffs against next.
+A snapshot written through is stored under the revision the save gave the
+item, which is the revision the next edit of the item is based on.
+"""
+import logging
+import threading
+
+from . import metrics
+from .metadatadiff import document_timespans, index_document
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_LOOKUPS = metrics.counter('portalplugintemplate_metadata_snapshot_lookups_total',
+                                   "Metadata snapshot cache lookups", ['result'])
+
+# Seconds a snapshot is trusted for, this bounds how stale it gets if the item is changed outside Portal
+SNAPSHOT_TIMEOUT = 300
+
+
+def document_field_values(metadata_document):
+    """ The field values of the -INF -> +INF timespan of a Vidispine metadata document, including
+        fields in field groups, as {field name: [value, ...]}
+    """
+    return index_document(metadata_document).values
+
+
+def document_snapshot(metadata_document, revision=None):
+    """ A snapshot of an item's current metadata document. The document's own revision is
+        used if it has one.
+    """
+    return {'revision': getattr(metadata_document, 'revision', None) or revision,
+            'fields': document_field_values(metadata_document),
+            'complete': True,
+            'timespans': document_timespans(metadata_document)}
+
+
+class MetadataSnapshotCache(object):
+    """ Cache of metadata snapshots in the Django cache, keyed by item id.
+
+        A snapshot is only returned if it was taken at the same metadata revision as the
+        caller expects (when both revisions are known), and if it contains every field the
+        caller is interested in. Hit and miss counters are kept per process.
+    """
+    def __init__(self, prefix='portalplugintemplate:metadatasnapshot', timeout=SNAPSHOT_TIMEOUT):
+        self.prefix = prefix
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _key(self, item_id):
+        return '%s:%s' % (self.prefix, item_id)
+
+    @staticmethod
+    def covers(snapshot, field_names, need_timespans=False):
+        """ Whether a snapshot has all the given fields, and the time based spans if needed
+        """
+        if snapshot is None:
+            return False
+        if need_timespans and snapshot.get('timespans') is None:
+            return False
+        if snapshot.get('complete'):
+            return True
+        fields = snapshot['fields']
+        return all(name in fields for name in field_names)
+
+    @classmethod
+    def _usable(cls, snapshot, revision, field_names, need_timespans):
+        if snapshot is None:
+            return False
+        if revision and snapshot['revision'] and revision != snapshot['revision']:
+            return False
+        return cls.covers(snapshot, field_names, need_timespans)
+
+    def get(self, item_id, revision=None, field_names=(), need_timespans=False):
+        from django.core.cache import cache
+        try:
+            snapshot = cache.get(self._key(item_id))
+        except Exception:
+            log.exception("Failed getting metadata snapshot of %s" % item_id)
+            snapshot = None
+        with self._lock:
+            usable = self._usable(snapshot, revision, field_names, need_timespans)
+            if usable:
+                self.hits += 1
+            else:
+                self.misses += 1
+        SNAPSHOT_LOOKUPS.inc('hit' if usable else 'miss')
+        return snapshot if usable else None
+
+    def set(self, item_id, snapshot):
+        from django.core.cache import cache
+        try:
+            cache.set(self._key(item_id), snapshot, self.timeout)
+        except Exception:
+            log.exception("Failed storing metadata snapshot of %s" % item_id)
+
+    def update(self, item_id, field_values, revision, timespans_changed=False):
+        """ Write new field values through to an existing snapshot, after the item was updated.
+            `revision` is the revision the item got from the save, so the next update based on it
+            uses the snapshot and an update based on any other revision fetches the metadata again.
+            Without a revision the snapshot is invalidated instead. Time based metadata isn't written
+            through, if it was changed it is fetched again when needed.
+        """
+        if not revision:
+            self.invalidate(item_id)
+            return
+        from django.core.cache import cache
+        try:
+            snapshot = cache.get(self._key(item_id))
+        except Exception:
+            log.exception("Failed getting metadata snapshot of %s" % item_id)
+            snapshot = None
+        if snapshot is None:
+            return
+        fields = dict(snapshot['fields'])
+        fields.update(field_values)
+        timespans = None if timespans_changed else snapshot.get('timespans')
+        self.set(item_id, {'revision': revision, 'fields': fields, 'complete': snapshot.get('complete', False),
+                           'timespans': timespans})
+
+    def invalidate(self, item_id):
+        from django.core.cache import cache
+        try:
+            cache.delete(self._key(item_id))
+        except Exception:
+            log.exception("Failed invalidating metadata snapshot of %s" % item_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,144 @@
+"""
+A visit spool shared by all Portal processes through the Django cache.
+
+Every process appends what it has collected to the bucket for the current
+interval. Once an interval is over, the first process to claim its bucket
+merges the entries from every process and is the only one to write them to
+Vidispine, so the backend sees one write per interval for the whole cluster
+instead of one per process.
+
+The Django cache needs to be shared between the processes (memcached, redis,
+database or file based cache) for this to coalesce anything. With the
+default local memory cache every process simply gets its own spool, which
+behaves like having no spool at all.
+
+A process that shuts down takes back what it published and nobody has
+collected yet with reclaim(), so nothing is left behind in a spool that no
+other process will collect, as with the local memory cache.
+"""
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class SharedVisitSpool(object):
+    """ Interval bucketed spool on top of the Django cache.
+
+        A bucket is closed `grace` seconds after its interval has ended, which
+        gives processes that were in the middle of publishing time to finish.
+        Closed buckets are claimed with cache.add(), which is atomic on all
+        shared cache backends, so exactly one process collects each bucket.
+    """
+    def __init__(self, prefix, interval, grace=5, lookback=10):
+        self.prefix = prefix
+        self.interval = interval
+        self.grace = grace
+        # How many closed buckets to look at, buckets older than this have expired
+        self.lookback = lookback
+        self.timeout = interval * (lookback + 2) + grace
+        # (bucket, slot) of the entries this process published, for reclaim()
+        self._published = []
+        self._published_pid = os.getpid()
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        # Imported at call-time, the cache is not necessarily configured when this module is loaded
+        from django.core.cache import cache
+        return cache
+
+    def _key(self, *parts):
+        return ':'.join([self.prefix] + [str(p) for p in parts])
+
+    def bucket(self, now=None):
+        if now is None:
+            now = time.time()
+        return int(now // self.interval)
+
+    def publish(self, entries, now=None):
+        """ Append entries to the bucket of the current interval.
+            Entries must be picklable, duplicates across processes are merged by collect()
+        """
+        entries = list(entries)
+        if not entries:
+            return
+        cache = self.cache
+        bucket = self.bucket(now)
+        seq_key = self._key('seq', bucket)
+        cache.add(seq_key, 0, self.timeout)
+        try:
+            slot = cache.incr(seq_key)
+        except ValueError:
+            # The counter expired between add() and incr()
+            cache.add(seq_key, 0, self.timeout)
+            slot = cache.incr(seq_key)
+        cache.set(self._key('slot', bucket, slot), entries, self.timeout)
+        with self._lock:
+            if self._published_pid != os.getpid():
+                # Forked, the parent's slots are the parent's to reclaim
+                self._published = []
+                self._published_pid = os.getpid()
+            oldest = bucket - self.lookback - 1
+            self._published = [(b, n) for b, n in self._published if b >= oldest]
+            self._published.append((bucket, slot))
+
+    def closed_buckets(self, now=None):
+        if now is None:
+            now = time.time()
+        last_closed = self.bucket(now - self.grace) - 1
+        return range(last_closed - self.lookback + 1, last_closed + 1)
+
+    def collect(self, now=None):
+        """ Claim every closed bucket nobody has claimed yet and return their merged entries,
+            oldest first and without duplicates. Returns an empty list if there was nothing
+            to collect or other processes got there first.
+        """
+        cache = self.cache
+        seq_keys = dict((self._key('seq', bucket), bucket) for bucket in self.closed_buckets(now))
+        counts = cache.get_many(list(seq_keys))
+        merged = []
+        seen = set()
+        for seq_key, bucket in sorted(seq_keys.items(), key=lambda kv: kv[1]):
+            count = counts.get(seq_key)
+            if not count:
+                continue
+            if not cache.add(self._key('claim', bucket), os.getpid(), self.timeout):
+                # Another process is the flusher for this bucket
+                continue
+            slot_keys = [self._key('slot', bucket, slot) for slot in range(1, count + 1)]
+            slots = cache.get_many(slot_keys)
+            for slot_key in slot_keys:
+                for entry in slots.get(slot_key, ()):
+                    if entry not in seen:
+                        seen.add(entry)
+                        merged.append(entry)
+            cache.delete_many(slot_keys + [seq_key])
+            log.debug("Collected %d slots from visit spool bucket %s" % (len(slots), bucket))
+        return merged
+
+    def reclaim(self):
+        """ Take back the entries this process published which no process has collected yet,
+            oldest first and without duplicates. An entry collected at the same time may be
+            returned by both, but none is lost.
+        """
+        with self._lock:
+            published = self._published if self._published_pid == os.getpid() else []
+            self._published = []
+        if not published:
+            return []
+        cache = self.cache
+        slot_keys = [self._key('slot', bucket, slot) for bucket, slot in published]
+        slots = cache.get_many(slot_keys)
+        merged = []
+        seen = set()
+        for slot_key in slot_keys:
+            for entry in slots.get(slot_key, ()):
+                if entry not in seen:
+                    seen.add(entry)
+                    merged.append(entry)
+        cache.delete_many(list(slots))
+        log.debug("Reclaimed %d uncollected slots from the visit spool" % len(slots))
+        return merged
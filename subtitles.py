@@ -0,0 +1,457 @@
+"""
+Subtitles of items as WebVTT, for the video player.
+
+The subtitle shape of an item is the first shape with one of the
+SUBTITLE_SHAPE_TAGS whose file is WebVTT, SRT or TTML. Which shape that is,
+as seen by a user, is cached in the Django cache, so repeat plays don't ask
+Vidispine again. The shape is looked up as the user (RunAs), which makes
+Vidispine check that the user may access the item.
+
+The file is converted to WebVTT while it is streamed from Vidispine, a line
+or a cue at a time, and written to a cache file on local disk named by the
+shape id and a version derived from the file's hash, size and timestamp.
+A new version of the file gets a new cache file. Earlier versions are left
+in place, a user whose cached shape lookup is older may still ask for them,
+and are removed by sweep_subtitle_cache() once they haven't been served for
+SUBTITLE_CACHE_MAX_AGE seconds, or least recently served first when the
+directory grows past SUBTITLE_CACHE_MAX_BYTES. The sweep runs at most every
+SUBTITLE_CACHE_SWEEP_INTERVAL seconds per process, after a new file is
+written. Files are written to a temporary name and renamed when complete, so
+a partly written file is never served.
+
+TTML timing on <p> elements is supported (clock times, offsets in h/m/s/ms,
+frames and ticks). Timing inherited from enclosing <body>, <div> or <span>
+elements is not.
+"""
+import codecs
+import glob
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from xml.etree import ElementTree
+
+try:
+    from urllib.error import HTTPError, URLError
+except ImportError:
+    from urllib2 import HTTPError, URLError
+
+from .vsclient import CircuitOpenError, vsapi
+
+log = logging.getLogger(__name__)
+
+# Shape tags of subtitle shapes, in order of preference
+SUBTITLE_SHAPE_TAGS = ('subtitle', 'webvtt')
+# How long the subtitle shape of an item is cached per user, and how long "no subtitles" is
+SUBTITLE_RESOLVE_TIMEOUT = 300
+SUBTITLE_MISSING_TIMEOUT = 60
+READ_CHUNK_SIZE = 64 * 1024
+# Cache files not served for this long are removed, and the least recently served ones first when the
+# directory is larger than SUBTITLE_CACHE_MAX_BYTES
+SUBTITLE_CACHE_MAX_AGE = 7 * 24 * 3600
+SUBTITLE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+SUBTITLE_CACHE_SWEEP_INTERVAL = 3600
+# How often the modification time of a served cache file is updated, it's the file's last use
+SUBTITLE_CACHE_TOUCH_INTERVAL = 3600
+
+VS_NS = '{http://xml.vidispine.com/schema/vidispine}'
+TTML_PARAMETER_NS = '{http://www.w3.org/ns/ttml#parameter}'
+
+FORMATS_BY_EXTENSION = {
+    '.vtt': 'vtt',
+    '.webvtt': 'vtt',
+    '.srt': 'srt',
+    '.ttml': 'ttml',
+    '.dfxp': 'ttml',
+    '.xml': 'ttml',
+}
+FORMATS_BY_MIME_TYPE = {
+    'text/vtt': 'vtt',
+    'application/x-subrip': 'srt',
+    'text/srt': 'srt',
+    'application/ttml+xml': 'ttml',
+}
+
+
+class SubtitleError(Exception):
+    """ Vidispine couldn't be asked or the subtitle file couldn't be converted
+    """
+    pass
+
+
+_sweep_lock = threading.Lock()
+_last_sweep = [0]
+
+
+def subtitle_cache_dir():
+    from django.conf import settings
+    return getattr(settings, 'PORTALPLUGINTEMPLATE_SUBTITLE_CACHE_DIR',
+                   os.path.join(tempfile.gettempdir(), 'portalplugintemplate-subtitles'))
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _read_xml(response):
+    try:
+        return ElementTree.parse(response).getroot()
+    finally:
+        response.close()
+
+
+def _request_xml(path, params=None, runas=None):
+    return _read_xml(vsapi.request(path, params, headers={'Accept': 'application/xml'}, runas=runas))
+
+
+def _subtitle_file(shape_id, shape):
+    """ {'shape_id', 'file_id', 'format', 'version'} of the first subtitle file of a ShapeDocument
+    """
+    mime_format = FORMATS_BY_MIME_TYPE.get((shape.findtext(VS_NS + 'mimeType') or '').split(';')[0].strip())
+    for file_element in shape.iter(VS_NS + 'file'):
+        file_id = file_element.findtext(VS_NS + 'id')
+        path = file_element.findtext(VS_NS + 'path') or ''
+        subtitle_format = FORMATS_BY_EXTENSION.get(os.path.splitext(path)[1].lower(), mime_format)
+        if not file_id or subtitle_format is None:
+            continue
+        version = ':'.join(value or '' for value in (
+            shape.findtext(VS_NS + 'essenceVersion'), file_id, file_element.findtext(VS_NS + 'hash'),
+            file_element.findtext(VS_NS + 'size'), file_element.findtext(VS_NS + 'timestamp')))
+        return {
+            'shape_id': shape_id,
+            'file_id': file_id,
+            'format': subtitle_format,
+            'version': hashlib.sha1(version.encode('utf-8')).hexdigest()[:16],
+        }
+    return None
+
+
+def _find_subtitle(item_id, user):
+    for tag in SUBTITLE_SHAPE_TAGS:
+        uri_list = _request_xml('item/%s/shape' % item_id, {'tag': tag}, runas=user)
+        for uri in uri_list.iter(VS_NS + 'uri'):
+            shape_id = (uri.text or '').strip()
+            if not shape_id:
+                continue
+            subtitle = _subtitle_file(shape_id, _request_xml('item/%s/shape/%s' % (item_id, shape_id), runas=user))
+            if subtitle is not None:
+                return subtitle
+    return None
+
+
+def resolve_subtitle(item_id, user):
+    """ The subtitle shape of an item as seen by the user, as {'shape_id', 'file_id', 'format', 'version'}.
+        None if the item has no subtitles or the user can't access it.
+    """
+    from django.core.cache import cache
+    # Usernames may have characters which aren't allowed in cache keys
+    key = 'portalplugintemplate:subtitles:%s:%s' % (
+        item_id, hashlib.sha1(user.username.encode('utf-8')).hexdigest())
+    subtitle = cache.get(key)
+    if subtitle is not None:
+        # An empty dict means there are no subtitles
+        return subtitle or None
+    try:
+        subtitle = _find_subtitle(item_id, user)
+    except HTTPError as e:
+        if e.code not in (403, 404):
+            raise SubtitleError("Failed looking up the subtitles of %s: %s" % (item_id, e))
+        subtitle = None
+    except (CircuitOpenError, URLError, IOError, ElementTree.ParseError) as e:
+        raise SubtitleError("Failed looking up the subtitles of %s: %s" % (item_id, e))
+    if subtitle is None:
+        cache.set(key, {}, SUBTITLE_MISSING_TIMEOUT)
+    else:
+        cache.set(key, subtitle, SUBTITLE_RESOLVE_TIMEOUT)
+    return subtitle
+
+
+def subtitle_etag(subtitle):
+    return '"%s-%s"' % (subtitle['shape_id'], subtitle['version'])
+
+
+def _text_reader(fileobj):
+    # utf-8-sig drops a byte order mark
+    return codecs.getreader('utf-8-sig')(fileobj, errors='replace')
+
+
+def vtt_to_vtt(fileobj):
+    reader = _text_reader(fileobj)
+    while True:
+        chunk = reader.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+_SRT_TIMING = re.compile(r'^\s*(\d+):(\d{2}):(\d{2})[,.](\d{1,3})\s*-->\s*(\d+):(\d{2}):(\d{2})[,.](\d{1,3})')
+
+
+def srt_to_vtt(fileobj):
+    """ WebVTT text of an SRT file, a line at a time. Cue numbers are kept as cue identifiers,
+        SRT cue coordinates are dropped.
+    """
+    yield 'WEBVTT\n\n'
+    for line in _text_reader(fileobj):
+        line = line.rstrip('\r\n')
+        match = _SRT_TIMING.match(line)
+        if match:
+            parts = match.groups()
+            line = '%s:%s:%s.%s --> %s:%s:%s.%s' % (
+                parts[0], parts[1], parts[2], parts[3].ljust(3, '0'),
+                parts[4], parts[5], parts[6], parts[7].ljust(3, '0'))
+        yield line + '\n'
+
+
+_CLOCK_TIME = re.compile(r'^(\d+):(\d{2}):(\d{2})(?:(\.\d+)|:(\d+)(?:\.(\d+))?)?$')
+_OFFSET_TIME = re.compile(r'^(\d+(?:\.\d+)?)(h|ms|m|s|f|t)$')
+
+
+def parse_ttml_time(value, frame_rate=30.0, tick_rate=1.0):
+    """ Seconds of a TTML time expression. Raises ValueError for unsupported expressions.
+    """
+    value = value.strip()
+    match = _CLOCK_TIME.match(value)
+    if match:
+        hours, minutes, seconds, fraction, frames, _subframes = match.groups()
+        total = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+        if fraction:
+            total += float(fraction)
+        if frames:
+            total += int(frames) / frame_rate
+        return total
+    match = _OFFSET_TIME.match(value)
+    if match:
+        count, unit = float(match.group(1)), match.group(2)
+        units = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001, 'f': 1.0 / frame_rate, 't': 1.0 / tick_rate}
+        return count * units[unit]
+    raise ValueError("Unsupported TTML time expression %r" % value)
+
+
+def format_vtt_time(seconds):
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return '%02d:%02d:%02d.%03d' % (hours, minutes, seconds, milliseconds)
+
+
+def _ttml_text(paragraph):
+    """ The text of a TTML <p>, with <br/> as line breaks and whitespace collapsed
+    """
+    parts = []
+
+    def walk(element):
+        if element.text:
+            parts.append(element.text)
+        for child in element:
+            if _local_name(child.tag) == 'br':
+                parts.append('\0')
+            else:
+                walk(child)
+            if child.tail:
+                parts.append(child.tail)
+
+    walk(paragraph)
+    text = re.sub(r'\s+', ' ', ''.join(parts))
+    lines = [line.strip() for line in text.split('\0')]
+    text = '\n'.join(line for line in lines if line)
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def ttml_to_vtt(fileobj):
+    """ WebVTT text of a TTML file, a cue at a time. Parsed elements are discarded once converted,
+        so memory use doesn't grow with the size of the file.
+    """
+    yield 'WEBVTT\n\n'
+    frame_rate, tick_rate = 30.0, 1.0
+    stack = []
+    for event, element in ElementTree.iterparse(fileobj, events=('start', 'end')):
+        if event == 'start':
+            stack.append(element)
+            if _local_name(element.tag) == 'tt':
+                frame_rate = float(element.get(TTML_PARAMETER_NS + 'frameRate', frame_rate))
+                multiplier = element.get(TTML_PARAMETER_NS + 'frameRateMultiplier')
+                if multiplier:
+                    numerator, denominator = multiplier.split()
+                    frame_rate = frame_rate * int(numerator) / int(denominator)
+                tick_rate = float(element.get(TTML_PARAMETER_NS + 'tickRate', tick_rate))
+            continue
+        stack.pop()
+        if _local_name(element.tag) != 'p':
+            continue
+        begin, end, duration = element.get('begin'), element.get('end'), element.get('dur')
+        try:
+            if begin is not None and (end or duration):
+                start = parse_ttml_time(begin, frame_rate, tick_rate)
+                if end:
+                    stop = parse_ttml_time(end, frame_rate, tick_rate)
+                else:
+                    stop = start + parse_ttml_time(duration, frame_rate, tick_rate)
+                text = _ttml_text(element)
+                if text:
+                    yield '%s --> %s\n%s\n\n' % (format_vtt_time(start), format_vtt_time(stop), text)
+        except ValueError as e:
+            log.debug("Skipping TTML cue: %s" % e)
+        if stack:
+            stack[-1].remove(element)
+
+
+CONVERTERS = {
+    'vtt': vtt_to_vtt,
+    'srt': srt_to_vtt,
+    'ttml': ttml_to_vtt,
+}
+
+
+def _cache_file_prefix(subtitle):
+    return re.sub(r'[^\w-]', '_', subtitle['shape_id'])
+
+
+def _touch(path):
+    """ Mark a cache file as recently served, so the sweep keeps it
+    """
+    try:
+        if time.time() - os.path.getmtime(path) >= SUBTITLE_CACHE_TOUCH_INTERVAL:
+            os.utime(path, None)
+    except OSError:
+        pass
+
+
+def cached_subtitle_path(subtitle):
+    """ Path of the subtitle file as WebVTT on local disk, fetched and converted first if it isn't cached
+    """
+    directory = subtitle_cache_dir()
+    prefix = _cache_file_prefix(subtitle)
+    path = os.path.join(directory, '%s-%s.vtt' % (prefix, subtitle['version']))
+    if os.path.exists(path):
+        _touch(path)
+        return path
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by another process in the meantime
+            if not os.path.isdir(directory):
+                raise
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.%s-' % prefix, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            response = vsapi.request('storage/file/%s/data' % subtitle['file_id'])
+            try:
+                for text in CONVERTERS[subtitle['format']](response):
+                    out.write(text.encode('utf-8'))
+            finally:
+                response.close()
+        # Atomic, a concurrent conversion of the same version writes the same content
+        os.rename(temp_path, path)
+    except Exception as e:
+        os.remove(temp_path)
+        if isinstance(e, (CircuitOpenError, URLError, IOError, ElementTree.ParseError)):
+            raise SubtitleError("Failed converting subtitle shape %s: %s" % (subtitle['shape_id'], e))
+        raise
+    log.debug("Cached subtitle shape %s as %s" % (subtitle['shape_id'], path))
+
+    with _sweep_lock:
+        sweep = time.time() - _last_sweep[0] >= SUBTITLE_CACHE_SWEEP_INTERVAL
+        if sweep:
+            _last_sweep[0] = time.time()
+    if sweep:
+        sweep_subtitle_cache(directory, keep=path)
+    return path
+
+
+def open_cached_subtitle(subtitle):
+    """ (open file, size) of the subtitle file as WebVTT, see cached_subtitle_path().
+        The file is converted again if it was swept between finding and opening it.
+    """
+    path = cached_subtitle_path(subtitle)
+    try:
+        fileobj = open(path, 'rb')
+    except (IOError, OSError):
+        fileobj = open(cached_subtitle_path(subtitle), 'rb')
+    return fileobj, os.fstat(fileobj.fileno()).st_size
+
+
+def sweep_subtitle_cache(directory=None, keep=None):
+    """ Remove cache files not served for SUBTITLE_CACHE_MAX_AGE seconds, then the least recently
+        served ones until the directory is no larger than SUBTITLE_CACHE_MAX_BYTES. Files served
+        within SUBTITLE_CACHE_TOUCH_INTERVAL seconds and `keep` are never removed.
+        Returns the number of files removed.
+    """
+    directory = directory or subtitle_cache_dir()
+    now = time.time()
+    files = []
+    for path in glob.glob(os.path.join(directory, '*.vtt')) + glob.glob(os.path.join(directory, '.*.tmp')):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+
+    removed = 0
+    total = sum(size for _mtime, size, _path in files)
+    for mtime, size, path in files:
+        age = now - mtime
+        if path == keep or age < SUBTITLE_CACHE_TOUCH_INTERVAL:
+            continue
+        if path.endswith('.tmp'):
+            # Left behind by a conversion that was killed, a running one writes more often than this
+            expired = True
+        else:
+            expired = age >= SUBTITLE_CACHE_MAX_AGE or total > SUBTITLE_CACHE_MAX_BYTES
+        if not expired:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    if removed:
+        log.info("Removed %d subtitle cache files from %s" % (removed, directory))
+    return removed
+
+
+def parse_range(header, size):
+    """ (first, last) byte of a single range Range header, None if there is no usable header.
+        Raises ValueError if the range can't be satisfied.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        # Multiple ranges aren't supported, the whole file is served instead
+        return None
+    first, _sep, last = header[len('bytes='):].strip().partition('-')
+    try:
+        first = int(first) if first else None
+        last = int(last) if last else None
+    except ValueError:
+        return None
+    if first is None:
+        if last is None:
+            return None
+        # The last N bytes
+        if last == 0 or size == 0:
+            raise ValueError("Range not satisfiable")
+        return max(0, size - last), size - 1
+    if first >= size or (last is not None and last < first):
+        raise ValueError("Range not satisfiable")
+    return first, size - 1 if last is None else min(last, size - 1)
+
+
+def iter_file(fileobj, length, chunk_size=READ_CHUNK_SIZE):
+    """ Up to `length` bytes from an open file, a chunk at a time. Closes the file.
+    """
+    try:
+        while length > 0:
+            data = fileobj.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fileobj.close()
@@ -3,8 +3,11 @@ URLS for the PortalPluginTemplate plugin
 """
 
 from django.conf.urls import url
-from .vmyplugin import (HelloWorldView, MyPluginModelsView, MyPluginModelAddView,
-                        MyPluginModelDeleteView, MyPluginModelView, MAMBackendInfoView)
+from .vmyplugin import (HelloWorldView, MyPluginModelsView, MyPluginModelsDataView, MyPluginModelAddView,
+                        MyPluginModelDeleteView, MyPluginModelExportView, MyPluginModelImportView,
+                        MyPluginModelResolveView, MyPluginModelView, MAMBackendInfoView,
+                        MAMBackendUsersView, RefreshWidgetFeedView, WidgetBatchRenderView, metrics_view,
+                        player_options_bundle, ItemSubtitlesView)
 
 urlpatterns = [
     # The URL defined to a hello world
@@ -13,13 +16,27 @@ urlpatterns = [
     # The model and form views
     url(r'^modelsandforms/$', MyPluginModelsView, name='my_plugin_models',
         kwargs={'template': 'portalplugintemplate/my_plugin_models_view.html'}),
+    url(r'^modelsandforms/data/$', MyPluginModelsDataView, name='my_plugin_models_data'),
     url(r'^modelsandforms/add/$', MyPluginModelAddView, name='add_my_plugin_model',
         kwargs={'template': 'portalplugintemplate/my_plugin_model_view.html'}),
     url(r'^modelsandforms/delete/$', MyPluginModelDeleteView, name='delete_my_plugin_model',
         kwargs={'template': 'admin/confirm_delete.html'}),
+    url(r'^modelsandforms/export/$', MyPluginModelExportView, name='export_my_plugin_models'),
+    url(r'^modelsandforms/import/$', MyPluginModelImportView, name='import_my_plugin_models'),
+    url(r'^modelsandforms/resolve/$', MyPluginModelResolveView, name='resolve_my_plugin_models'),
     url(r'^modelsandforms/(?P<slug>[-\w\s]+)/$', MyPluginModelView, name='my_plugin_model',
         kwargs={'template': 'portalplugintemplate/my_plugin_model_view.html'}),
     # MAM backend integration
     url(r'^mambackend/$',  MAMBackendInfoView, name='mam_backend_view',
         kwargs={'template': 'portalplugintemplate/mam_backend_view.html'}),
+    url(r'^mambackend/users/$', MAMBackendUsersView, name='mam_backend_users'),
+    # Dashboard widgets
+    url(r'^dashboard/refreshwidget/$', RefreshWidgetFeedView, name='refresh_widget_feed'),
+    url(r'^dashboard/render/$', WidgetBatchRenderView, name='render_widgets'),
+    # Video player subtitles and option bundles
+    url(r'^subtitles/(?P<item_id>[A-Za-z]+-\d+)/$', ItemSubtitlesView, name='item_subtitles'),
+    url(r'^playeroptions/(?P<block>\w+)\.(?P<digest>[0-9a-f]+)\.js$', player_options_bundle,
+        name='player_options_bundle'),
+    # Prometheus metrics
+    url(r'^metrics/$', metrics_view, name='metrics'),
 ]
@@ -0,0 +1,138 @@
+"""
+Shared cache of the Vidispine user directory, as seen by different users.
+
+Users are listed as the user (RunAs), so Vidispine only returns the users
+they may see. Results are cached in the Django cache per visibility scope:
+all superusers see the same users and share entries, other users get entries
+of their own. Entries are refreshed in the background after
+USER_DIRECTORY_TIMEOUT seconds, and the last good result is served while
+Vidispine is failing.
+
+Pages of the listing are fetched from Vidispine with first/number and cached
+page by page, so a page costs the same however large the directory is.
+Vidispine can't search users by a part of their username or real name, so
+searches are answered from the whole directory, fetched once per scope. The
+pages of a search are cached too, so only the first request of a search page
+scans the directory.
+
+Users are cached as {'username': ..., 'name': ...} dicts.
+"""
+import hashlib
+from xml.etree import ElementTree
+
+try:
+    from urllib.error import HTTPError, URLError
+except ImportError:
+    from urllib2 import HTTPError, URLError
+
+from portal.vidispine.iuser import UserHelper
+
+from .caching import StaleWhileRevalidateCache
+from .vsclient import CircuitOpenError, vsapi
+# Note: The following package must be imported at call-time in methods to prevent circular dependencies:
+# from django.core.cache import cache
+
+USER_DIRECTORY_TIMEOUT = 300
+# How long the last good result is served if refreshing it keeps failing
+USER_DIRECTORY_STALE_TIMEOUT = 24 * 3600
+USERS_PAGE_SIZE = 50
+MAX_USERS_PAGE_SIZE = 500
+
+VS_NS = '{http://xml.vidispine.com/schema/vidispine}'
+
+_cache = StaleWhileRevalidateCache('portalplugintemplate:userdirectory', USER_DIRECTORY_TIMEOUT,
+                                   USER_DIRECTORY_STALE_TIMEOUT)
+
+
+class UserDirectoryError(Exception):
+    pass
+
+
+def visibility_scope(user):
+    if user.is_superuser:
+        return 'superuser'
+    return 'user:%s' % user.username
+
+
+def _scope_key(user):
+    # Usernames may have characters which aren't allowed in cache keys
+    return hashlib.sha1(visibility_scope(user).encode('utf-8')).hexdigest()
+
+
+def _generation_key(user):
+    return 'portalplugintemplate:userdirectory:%s:generation' % _scope_key(user)
+
+
+def _generation(user):
+    from django.core.cache import cache
+    return cache.get(_generation_key(user), 0)
+
+
+def _fetch_users(user):
+    uh = vsapi.helper(UserHelper, runas=user)
+    # Get all users that are visible to the user
+    res = vsapi.call(func=uh.getAllUsers, args={'includeSelf': True, 'includeDisabled': True},
+                     vsapierror_templateorcode=None, idempotent=True)
+    if not res['success']:
+        raise UserDirectoryError(res['exception']['error'])
+    return [{'username': u.getUserName(), 'name': u.getName()} for u in res['response']]
+
+
+def _fetch_page(user, first, number):
+    """ (total, [user, ...]) of a page of the users visible to the user, from a UserListDocument
+    """
+    try:
+        response = vsapi.request('user', {'first': first, 'number': number, 'disabled': 'true'},
+                                 headers={'Accept': 'application/xml'}, runas=user)
+        try:
+            document = ElementTree.parse(response).getroot()
+        finally:
+            response.close()
+    except (HTTPError, URLError, CircuitOpenError, ElementTree.ParseError) as e:
+        raise UserDirectoryError(str(e))
+    users = [{'username': u.findtext(VS_NS + 'userName'), 'name': u.findtext(VS_NS + 'realName')}
+             for u in document.findall(VS_NS + 'user')]
+    hits = document.findtext(VS_NS + 'hits') or document.get('hits')
+    return (int(hits) if hits else first + len(users)), users
+
+
+def get_user_directory(user):
+    """ All users visible to the user. Raises UserDirectoryError if they can't be fetched
+        and there is no earlier list to fall back to.
+    """
+    return _cache.get('%s:all' % _scope_key(user), lambda: _fetch_users(user))
+
+
+def invalidate_user_directory(user):
+    """ Drop the cached users and pages of the user's visibility scope
+    """
+    from django.core.cache import cache
+    _cache.invalidate('%s:all' % _scope_key(user))
+    key = _generation_key(user)
+    # Pages of earlier generations are never read again and expire on their own
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted between add() and incr()
+        cache.set(key, 1, None)
+
+
+def _search_page(user, query, first, number):
+    users = [u for u in get_user_directory(user)
+             if query in (u['username'] or '').lower() or query in (u['name'] or '').lower()]
+    return len(users), users[first:first + number]
+
+
+def get_user_page(user, query='', first=0, number=USERS_PAGE_SIZE):
+    """ A page of the users visible to the user whose username or real name contains the query,
+        as (total number of matching users, [user, ...])
+    """
+    query = query.strip().lower()
+    number = min(max(number, 1), MAX_USERS_PAGE_SIZE)
+    first = max(first, 0)
+    key = '%s:%s:page:%s:%s' % (_scope_key(user), _generation(user), first, number)
+    if not query:
+        return tuple(_cache.get(key, lambda: _fetch_page(user, first, number)))
+    key = '%s:%s' % (key, hashlib.sha1(query.encode('utf-8')).hexdigest())
+    return tuple(_cache.get(key, lambda: _search_page(user, query, first, number)))
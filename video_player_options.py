@@ -4,68 +4,130 @@ An example and test plugin for Item Page, SubClip Page, Sharing Page and Annotat
 These plugins are supported in Portal 3.4.4 and later.
 
 Some of these examples are available in documentation as well.
+
+The JavaScript of these plugins is not returned inline on every page view. The code of all plugins of a
+pluginblock is served as one cacheable bundle, see playerbundles.py, and return_string() only references it.
+The bundle of MediaViewVideoPlayerOptionsJS is loaded ahead by BundlePreloadPlugin.
 """
 
 from portal.generic.plugin_interfaces import IPluginBlock
 from portal.pluginbase.core import Plugin, implements
 
+from .playerbundles import (PRELOAD_BLOCKS, add_to_bundle, bundle_reference, get_bundle, is_first_contributor,
+                            preload_reference)
+
+
+# Placeholders in javascript_code for the subtitle URL of an item, the item id goes between them
+SUBTITLE_URL_PREFIX = '__SUBTITLE_URL_PREFIX__'
+SUBTITLE_URL_SUFFIX = '__SUBTITLE_URL_SUFFIX__'
+
+
+def bundle_url(block):
+    from django.core.urlresolvers import reverse
+    digest, _content = get_bundle(block)
+    return reverse('player_options_bundle', kwargs={'block': block, 'digest': digest})
+
+
+class BundledJSPlugin(Plugin):
+    """
+    Base class for pluginblock plugins whose javascript_code is served from the bundle of the pluginblock.
+    Subclasses set name and plugin_guid before calling BundledJSPlugin.__init__().
+    """
+    javascript_code = ''
+
+    def __init__(self):
+        add_to_bundle(self.name, self.plugin_guid, self.get_javascript_code)
+
+    def get_javascript_code(self):
+        """ javascript_code with the subtitle URL placeholders filled in, called when the bundle is built
+        """
+        if SUBTITLE_URL_PREFIX not in self.javascript_code:
+            return self.javascript_code
+        from django.core.urlresolvers import reverse
+        placeholder_id = 'VX-0'
+        prefix, suffix = reverse('item_subtitles', kwargs={'item_id': placeholder_id}).split(placeholder_id)
+        return self.javascript_code.replace(SUBTITLE_URL_PREFIX, prefix).replace(SUBTITLE_URL_SUFFIX, suffix)
+
+    def return_string(self, tagname, *args):
+        # The first plugin of the block references the bundle, which has the code of all of them
+        if not is_first_contributor(self.name, self.plugin_guid):
+            return {'guid': self.plugin_guid, 'string': ''}
+        return {'guid': self.plugin_guid, 'string': bundle_reference(self.name, bundle_url(self.name))}
+
 
-class ItemPageCustomSubtitlesPlugin(Plugin):
+class BundlePreloadPlugin(Plugin):
     """
-    Add a (hard coded) custom subtitle source to Item page video player.
+    Loads the bundle of MediaViewVideoPlayerOptionsJS with a deferred script tag, from an HTML block rendered on
+    the item page, so the player doesn't have to load it synchronously.
     """
     implements(IPluginBlock)
 
     def __init__(self):
-        self.name = "MediaViewVideoPlayerOptionsJS"
-        self.plugin_guid = 'bf729d14-caa1-4978-96c8-0927361bcb07'
+        self.block = "MediaViewVideoPlayerOptionsJS"
+        self.name = PRELOAD_BLOCKS[self.block]
+        self.plugin_guid = 'aaa26b5b-f217-4def-9b65-efb44d2cf008'
 
     def return_string(self, tagname, *args):
-        # For simplicity: Return JavaScript defined directly in this source file.
-        # Best practice is to use a separate template file.
-        javascript_code = """
-            // ItemPageCustomSubtitlesPlugin: Override subtitles with a hardcoded custom WEBVTT source
+        if get_bundle(self.block) is None:
+            return {'guid': self.plugin_guid, 'string': ''}
+        return {'guid': self.plugin_guid, 'string': preload_reference(bundle_url(self.block))}
+
+
+BundlePreloadPlugin()
+
+
+class ItemPageCustomSubtitlesPlugin(BundledJSPlugin):
+    """
+    Add a custom subtitle source to Item page video player, the subtitle shape of the item served by ItemSubtitlesView.
+    """
+    implements(IPluginBlock)
+
+    # For simplicity: JavaScript defined directly in this source file.
+    # Best practice is to use a separate file.
+    javascript_code = """
+        // ItemPageCustomSubtitlesPlugin: Override subtitles with the WEBVTT subtitles of the item on the page
+        var itemMatch = location.pathname.match(/\\/item\\/([A-Za-z]+-[0-9]+)/);
+        if (itemMatch) {
             // Item page playerOptions always has a timeline with one object.
             playerOptions.timeline[0].textTracks = [
                 {
                     code: "de",
                     kind: "subtitles",
                     name: gettext("German"),
-                    // This URL must point to an endpoint that returns WEBVTT formatted subtitles, e.g. the
-                    // following assumes item VX-4 has shape VX-6 that is a .webvtt file for current media item.
-                    url: "/vs/item/download/VX-4/?shape=VX-6"
+                    // Returns the item's subtitle shape as WEBVTT, see subtitles.py
+                    url: "__SUBTITLE_URL_PREFIX__" + itemMatch[1] + "__SUBTITLE_URL_SUFFIX__"
                 },
                 {
                     name: gettext("Disabled")
                 }
             ];
-        """
+        }
+    """
 
-        return {'guid': self.plugin_guid, 'string': javascript_code}
+    def __init__(self):
+        self.name = "MediaViewVideoPlayerOptionsJS"
+        self.plugin_guid = 'bf729d14-caa1-4978-96c8-0927361bcb07'
+        BundledJSPlugin.__init__(self)
 
 
 ItemPageCustomSubtitlesPlugin()
 
 
-class ItemPageDisableSubtitlesPlugin(Plugin):
+class ItemPageDisableSubtitlesPlugin(BundledJSPlugin):
     """
     Example: Disable subtitles from item page.
     """
     implements(IPluginBlock)
 
+    javascript_code = """
+        // ItemPageCustomSubtitlesPlugin: Disable textTracks from player
+        playerOptions.timeline[0].textTracks = null;
+    """
+
     def __init__(self):
         self.name = "MediaViewVideoPlayerOptionsJS"
         self.plugin_guid = 'dbee3017-a8ff-4b90-bbb2-e9f77f0e12e6'
-
-    def return_string(self, tagname, *args):
-        # For simplicity: Return JavaScript defined directly in this source file.
-        # Best practice is to use a separate template file.
-        javascript_code = """
-            // ItemPageCustomSubtitlesPlugin: Disable textTracks from player
-            playerOptions.timeline[0].textTracks = null;
-        """
-
-        return {'guid': self.plugin_guid, 'string': javascript_code}
+        BundledJSPlugin.__init__(self)
 
 
 # Commented out since this and ItemPageCustomSubtitlesPlugin should not be enabled at the same time.
@@ -73,69 +135,63 @@ class ItemPageDisableSubtitlesPlugin(Plugin):
 # ItemPageDisableSubtitlesPlugin()
 
 
-class ItemPageDisableCreatePoster(Plugin):
+class ItemPageDisableCreatePoster(BundledJSPlugin):
     """
     Override player options to disable poster image creation with "camera" button.
     """
     implements(IPluginBlock)
 
+    javascript_code = """
+        // ItemPageDisableCreatePoster: Disable poster creation from video player
+        playerOptions.grabStills = false;
+    """
+
     def __init__(self):
         self.name = "MediaViewVideoPlayerOptionsJS"
         self.plugin_guid = '8c7eb227-c0c4-42ad-83b9-257569fe11fc'
-
-    def return_string(self, tagname, *args):
-        # For simplicity: Return JavaScript defined directly in this source file.
-        # Best practice is to use a separate template file.
-        javascript_code = """
-            // ItemPageDisableCreatePoster: Disable poster creation from video player
-            playerOptions.grabStills = false;
-        """
-
-        return {'guid': self.plugin_guid, 'string': javascript_code}
+        BundledJSPlugin.__init__(self)
 
 
 ItemPageDisableCreatePoster()
 
 
-class AnnotationToolCustomSubtitles(Plugin):
+class AnnotationToolCustomSubtitles(BundledJSPlugin):
     """
     Override player options in Annotation Tool to add custom subtitles.
     """
     implements(IPluginBlock)
 
+    # Plain JavaScript, the bundle is included with a <script> tag
+    javascript_code = """
+        $(document).ready(function() {
+            cntmo.app.annotationTool.playerOptionHandler = function(playerOptions) {
+                var itemMatch = location.pathname.match(/\\/item\\/([A-Za-z]+-[0-9]+)/);
+                if (!itemMatch) {
+                    return playerOptions;
+                }
+                // Set custom textTrack data with a single subtitle source on by default, secondary option
+                // disabled. In Annotation Tool, playerOptions.timeline always has one object.
+                playerOptions.timeline[0].textTracks = [
+                    {
+                        code: "de",
+                        kind: "subtitles",
+                        name: gettext("German"),
+                        // Returns the item's subtitle shape as WEBVTT, see subtitles.py
+                        url: "__SUBTITLE_URL_PREFIX__" + itemMatch[1] + "__SUBTITLE_URL_SUFFIX__"
+                    },
+                    {
+                        name: gettext("Disabled")
+                    }
+                ];
+                return playerOptions;
+            }
+        });
+    """
+
     def __init__(self):
         self.name = "AnnotationViewJS"
         self.plugin_guid = '66fcdc0c-b89d-4c4a-8578-04a8d829ae0f'
-
-    def return_string(self, tagname, *args):
-        # For simplicity: Return JavaScript defined directly in this source file.
-        # Best practice is to use a separate template file.
-        javascript_code = """
-            <script>
-                $(document).ready(function() {
-                    cntmo.app.annotationTool.playerOptionHandler = function(playerOptions) {
-                        // Set custom textTrack data with a single subtitle source on by default, secondary option
-                        // disabled. In Annotation Tool, playerOptions.timeline always has one object.
-                        playerOptions.timeline[0].textTracks = [
-                            {
-                                code: "de",
-                                kind: "subtitles",
-                                name: gettext("German"),
-                                // This URL must point to an endpoint that returns WEBVTT formatted subtitles, e.g. the
-                                // following assumes item VX-4 / shape VX-6 is a .webvtt file for current media item.
-                                url: "/vs/item/download/VX-4/?shape=VX-6"
-                            },
-                            {
-                                name: gettext("Disabled")
-                            }
-                        ];
-                        return playerOptions;
-                    }
-                });
-            </script>
-        """
-
-        return {'guid': self.plugin_guid, 'string': javascript_code}
+        BundledJSPlugin.__init__(self)
 
 
 AnnotationToolCustomSubtitles()
@@ -2,17 +2,42 @@ from portal.generic.baseviews import ClassView
 from django.utils.translation import ugettext as _
 from django.contrib import messages
 
+import hmac
+import json
 import logging
+import os
 from .models import MyPluginModel
+from .export import EXPORT_FORMATS, iter_rows
+from .externalids import resolve_external_ids
+from .importer import PARSERS as IMPORT_PARSERS, import_file
+from .metrics import REGISTRY, instrument_view
+from .playerbundles import get_bundle
+from .subtitles import (SubtitleError, iter_file, open_cached_subtitle, parse_range, resolve_subtitle,
+                        subtitle_etag)
+from .userdirectory import USERS_PAGE_SIZE, UserDirectoryError, get_user_page
+from .widgetfeed import MAX_INTERVAL, MIN_INTERVAL, current_payload, wait_for_change
+from .widgetrender import MAX_BATCH_WIDGETS, render_widgets
 from django.shortcuts import get_object_or_404
+from django.db import transaction
 from .forms import MyPluginForm
-from django.http import HttpResponseRedirect
+from django.conf import settings
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden,
+                         HttpResponseNotModified, HttpResponseRedirect, JsonResponse, StreamingHttpResponse)
+from django.utils.html import format_html
 from django.core.urlresolvers import reverse
-from portal.vidispine.iuser import UserHelper
-from portal.vidispine.igeneral import performVSAPICall
 log = logging.getLogger(__name__)
 
+# How long browsers may cache a player options bundle, a changed bundle gets a new URL
+BUNDLE_MAX_AGE = 365 * 24 * 3600
+# Token which lets e.g. the Prometheus server read the metrics without logging in, sent as
+# "Authorization: Bearer <token>". None to only let logged in superusers read them.
+METRICS_TOKEN = getattr(settings, 'PORTALPLUGINTEMPLATE_METRICS_TOKEN', None)
+# Opt-in: addresses allowed to read the metrics without logging in or a token. Only for scrapes made
+# directly to Portal, behind a reverse proxy every request comes from the proxy's address.
+METRICS_ALLOWED_IPS = getattr(settings, 'PORTALPLUGINTEMPLATE_METRICS_ALLOWED_IPS', ())
 
+
+@instrument_view
 class HelloWorldView(ClassView):
     """
     Shows all the format rules
@@ -25,15 +50,113 @@ class HelloWorldView(ClassView):
         return self.main(self.request, self.template, extra_context)
 
 
+@instrument_view
 class MyPluginModelsView(ClassView):
     """ View all MyPluginModels
+        The rows are loaded page by page from MyPluginModelsDataView
     """
     def __call__(self):
-        _objs = MyPluginModel.objects.all()
-        ctx = {"objects":_objs}
+        ctx = {"objects_exist": MyPluginModel.objects.exists()}
         return self.main(self.request, self.template, ctx)
 
 
+@instrument_view
+class MyPluginModelsDataView(ClassView):
+    """ One page of MyPluginModels for the DataTables table in MyPluginModelsView, using
+        DataTables server-side processing. Filtering, ordering and paging are done in the database.
+    """
+    # DataTables column index -> order by field, the checkbox column can't be sorted
+    sort_columns = {0: 'name', 1: 'description'}
+    max_page_size = 500
+
+    def __call__(self):
+        params = self.request.GET
+        try:
+            start = max(int(params.get('iDisplayStart', 0)), 0)
+            length = min(max(int(params.get('iDisplayLength', 50)), 1), self.max_page_size)
+            sort_column = int(params.get('iSortCol_0', 0))
+        except ValueError:
+            return HttpResponseBadRequest("Invalid paging parameters")
+        order_by = self.sort_columns.get(sort_column, 'name')
+        if params.get('sSortDir_0') == 'desc':
+            order_by = '-' + order_by
+
+        total = MyPluginModel.objects.count()
+        search = params.get('sSearch', '').strip()
+        _objs = MyPluginModel.objects.search(search)
+        total_matching = _objs.count() if search else total
+        # Order by pk as well, so rows with the same name don't move between pages
+        page = _objs.order_by(order_by, 'pk').only('pk', 'name', 'description')[start:start + length]
+
+        rows = []
+        for obj in page:
+            url = reverse('my_plugin_model', args=[obj.pk])
+            rows.append([
+                format_html('<a href="{}">{}</a>', url, obj.name),
+                format_html('<a href="{}">{}</a>', url, obj.description or ''),
+                format_html('<input type="checkbox" value="{}" name="selected_objects" />', obj.pk),
+            ])
+        return JsonResponse({
+            'sEcho': int(params.get('sEcho', 0) or 0),
+            'iTotalRecords': total,
+            'iTotalDisplayRecords': total_matching,
+            'aaData': rows,
+        })
+
+
+@instrument_view
+class MyPluginModelExportView(ClassView):
+    """ Stream all MyPluginModels, or the ones matching the search parameter, as CSV
+        (format=csv, the default) or JSON Lines (format=jsonl)
+    """
+    def __call__(self):
+        export_format = self.request.GET.get('format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            return HttpResponseBadRequest("Unknown export format: %s" % export_format)
+        lines, content_type, extension = EXPORT_FORMATS[export_format]
+        _objs = MyPluginModel.objects.search(self.request.GET.get('search', '').strip())
+        log.debug("%s exporting MyPluginModels as %s" % (self.request.user, export_format))
+        response = StreamingHttpResponse(lines(iter_rows(_objs)), content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="mypluginmodels.%s"' % extension
+        return response
+
+
+@instrument_view
+class MyPluginModelImportView(ClassView):
+    """ Import an uploaded CSV or JSON Lines file (the file parameter) of MyPluginModels,
+        upserting on external id. Returns the import result as JSON.
+    """
+    def __call__(self):
+        if self.request.method != 'POST' or 'file' not in self.request.FILES:
+            return HttpResponseBadRequest("POST a CSV or JSON Lines file as 'file'")
+        upload = self.request.FILES['file']
+        import_format = self.request.POST.get('format') or os.path.splitext(upload.name)[1].lstrip('.').lower()
+        if import_format not in IMPORT_PARSERS:
+            return HttpResponseBadRequest("Unknown import format: %s" % import_format)
+        log.debug("%s importing MyPluginModels from %s" % (self.request.user, upload.name))
+        result = import_file(upload, import_format)
+        return JsonResponse(result.as_dict())
+
+
+@instrument_view
+class MyPluginModelResolveView(ClassView):
+    """ Resolve external ids to MyPluginModels in one go.
+        Takes the ids as repeated external_id parameters (GET or POST) and returns
+        {external id: [{"id": ..., "name": ..., "description": ..., "external_id": ...}, ...]} as JSON.
+    """
+    def __call__(self):
+        params = self.request.POST if self.request.method == 'POST' else self.request.GET
+        try:
+            resolved = resolve_external_ids(params.getlist('external_id'))
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        return JsonResponse(dict(
+            (external_id, [{"id": obj.pk, "name": obj.name, "description": obj.description,
+                            "external_id": obj.external_id} for obj in objs])
+            for external_id, objs in resolved.items()))
+
+
+@instrument_view
 class MyPluginModelView(ClassView):
     """ View a particular MyPluginModel
     """
@@ -57,40 +180,101 @@ class MyPluginModelView(ClassView):
         return self.main(self.request, self.template, ctx)
 
 
+def _parse_pks(values):
+    """ Primary keys from request values, values which aren't valid keys are returned separately
+    """
+    pks = []
+    invalid = []
+    for value in values:
+        try:
+            pks.append(int(value))
+        except (TypeError, ValueError):
+            invalid.append(value)
+    return pks, invalid
+
+
+@instrument_view
 class MyPluginModelDeleteView(ClassView):
-    """ Delete a particular MyPluginModel
+    """ Delete the selected MyPluginModels, or all MyPluginModels matching a search
+        (the delete_search parameter). Rows are deleted a chunk at a time in a single transaction.
     """
+    delete_chunk_size = 1000
+    # Number of matching rows listed when confirming a delete by search
+    preview_size = 100
+
     def __call__(self):
+        search = self.request.POST.get('delete_search', self.request.GET.get('delete_search'))
+        if search is not None and not search.strip():
+            messages.error(self.request, _("Please enter a search for the My Plugin Models to delete"))
+            return HttpResponseRedirect(reverse('my_plugin_models'))
+
         if self.request.method == 'POST':
-            _deletable_objects = self.request.POST.getlist('selected_objects')
-            for _d_o in _deletable_objects:
-                _obj = MyPluginModel.objects.get(pk=_d_o)
-                log.debug("%s deleted MyPluginModel %s" % (self.request.user, _obj.name))
-                _obj.delete()
-                _obj = None
+            if search is not None:
+                deleted = self.delete_matching(search)
+                log.debug("%s deleted %d MyPluginModels matching '%s'" % (self.request.user, deleted, search))
+            else:
+                deleted, missing = self.delete_pks(self.request.POST.getlist('selected_objects'))
+                log.debug("%s deleted %d MyPluginModels" % (self.request.user, deleted))
+                if missing:
+                    messages.error(self.request, _("%d of the selected My Plugin Models didn't exist") % len(missing))
             messages.success(self.request, _("Deleted My Plugin Model"))
             return HttpResponseRedirect(reverse('my_plugin_models'))
             
         else:
             log.debug("%s about to delete MyPluginModel" % self.request.user)
+            if search is not None:
+                _objs = MyPluginModel.objects.search(search)
+                ctx = {"search": search, "count": _objs.count(), "object_name": _("My Plugin Model"),
+                       "objects": _objs.order_by('pk')[:self.preview_size]}
+                return self.main(self.request, 'portalplugintemplate/confirm_delete_matching.html', ctx)
+
             _deletable_objects = self.request.GET.getlist('selected_objects')
             
             if len(_deletable_objects) < 1:
                 messages.error(self.request, _("Please pick a My Plugin Model to delete"))
                 return HttpResponseRedirect(reverse('my_plugin_models'))
             
-            objects = []
-            for (counter, i) in enumerate(_deletable_objects):
-                try:
-                    objects.append(MyPluginModel.objects.get(pk=i))
-                except MyPluginModel.DoesNotExist:
-                    messages.error(self.request, _("Tried to delete a My Plugin Model which didn't exist"))
-                    return HttpResponseRedirect(reverse('my_plugin_models'))
+            pks, invalid = _parse_pks(_deletable_objects)
+            _objs = MyPluginModel.objects.in_bulk(pks)
+            missing = invalid + [pk for pk in pks if pk not in _objs]
+            if missing:
+                messages.error(self.request, _("Tried to delete %d My Plugin Models which didn't exist") % len(missing))
+                return HttpResponseRedirect(reverse('my_plugin_models'))
+            objects = [_objs[pk] for pk in pks]
 
         ctx = { "deletable_objects": _deletable_objects, "object_name": _("My Plugin Model"), "objects":objects}
         return self.main(self.request, self.template, ctx)
 
+    def delete_pks(self, values):
+        """ Delete the MyPluginModels with the given primary keys.
+            Returns the number of deleted rows and the keys that didn't exist.
+        """
+        pks, missing = _parse_pks(values)
+        deleted = 0
+        with transaction.atomic():
+            for offset in range(0, len(pks), self.delete_chunk_size):
+                chunk = pks[offset:offset + self.delete_chunk_size]
+                existing = set(MyPluginModel.objects.filter(pk__in=chunk).values_list('pk', flat=True))
+                missing.extend(pk for pk in chunk if pk not in existing)
+                MyPluginModel.objects.filter(pk__in=existing).delete()
+                deleted += len(existing)
+        return deleted, missing
+
+    def delete_matching(self, search):
+        """ Delete all MyPluginModels matching a search, returns the number of deleted rows
+        """
+        deleted = 0
+        with transaction.atomic():
+            while True:
+                chunk = list(MyPluginModel.objects.search(search).order_by('pk')
+                             .values_list('pk', flat=True)[:self.delete_chunk_size])
+                if not chunk:
+                    return deleted
+                MyPluginModel.objects.filter(pk__in=chunk).delete()
+                deleted += len(chunk)
 
+
+@instrument_view
 class MyPluginModelAddView(ClassView):
     """ Add a MyPluginModel
     """
@@ -110,23 +294,186 @@ class MyPluginModelAddView(ClassView):
         return self.main(self.request, self.template, ctx)
 
 
+@instrument_view
 class MAMBackendInfoView(ClassView):
     """ View info from MAM backend
+        Renders the first page of users, the following pages are loaded from MAMBackendUsersView
     """
     def __call__(self):
         if self.request.method == 'GET':
-            uh = UserHelper(runas=self.request.user)
-            # Get all users that are visible to the logged in user
-            # This uses built-in functions in Portal.
-            # performVSAPICall to properly make the API call and return any potentiel exceptions
-            # UserHelper which is a helper class for interating with users in Vidispine
-            res = performVSAPICall(func=uh.getAllUsers, args={'includeSelf':True, 'includeDisabled':True}, 
-                                   vsapierror_templateorcode=None)
-            if not res['success']:
-                log.warning('Failed getting all users, error: %s' % res['exception']['error'])
-                _users = []
-            else:
-                _users = res['response']
+            # Get the users that are visible to the logged in user
+            # The user directory is cached and shared by all users who can see the same users,
+            # see userdirectory.py
+            try:
+                _total, _users = get_user_page(self.request.user)
+            except UserDirectoryError as e:
+                log.warning('Failed getting all users, error: %s' % e)
+                _total, _users = 0, []
 
-            ctx = {"users":_users}
+            ctx = {"users": _users, "total_users": _total, "page_size": USERS_PAGE_SIZE}
             return self.main(self.request, self.template, ctx)
+
+
+@instrument_view
+class MAMBackendUsersView(ClassView):
+    """ A page of the users visible to the logged in user as JSON, optionally matching a search.
+        Parameters: q (search), first and number.
+    """
+    def __call__(self):
+        params = self.request.GET
+        try:
+            first = int(params.get('first', 0))
+            number = int(params.get('number', USERS_PAGE_SIZE))
+        except ValueError:
+            return HttpResponseBadRequest("Invalid paging parameters")
+        try:
+            total, users = get_user_page(self.request.user, params.get('q', ''), first, number)
+        except UserDirectoryError as e:
+            log.warning('Failed getting all users, error: %s' % e)
+            return JsonResponse({"error": _("Failed getting users")}, status=502)
+        return JsonResponse({"total": total, "first": first, "users": users})
+
+
+@instrument_view
+class RefreshWidgetFeedView(ClassView):
+    """ The content of RefreshWidget as JSON, computed once per refresh interval for all dashboards.
+        Parameters: interval (seconds) and wait (seconds to wait for new content, long-poll).
+        Answers 304 if the If-None-Match header has the current content.
+    """
+    def __call__(self):
+        from .dashboard_widget_examples import RefreshWidget
+        params = self.request.GET
+        try:
+            interval = int(params.get('interval', RefreshWidget.default_interval))
+            wait = float(params.get('wait', 0))
+        except ValueError:
+            return HttpResponseBadRequest("Invalid interval or wait")
+        interval = min(max(interval, MIN_INTERVAL), MAX_INTERVAL)
+        request = self.request
+
+        def compute():
+            return RefreshWidget.get_render_data({}, {'refresh_interval': interval}, request)['content']
+
+        etag = self.request.META.get('HTTP_IF_NONE_MATCH')
+        if etag and wait > 0:
+            payload = wait_for_change('RefreshWidget', interval, compute, etag, wait)
+        else:
+            payload = current_payload('RefreshWidget', interval, compute)
+        if etag == payload['etag']:
+            response = HttpResponseNotModified()
+        else:
+            response = JsonResponse({'content': payload['content'], 'interval': interval})
+        response['ETag'] = payload['etag']
+        # Browsers must always ask, a 304 is cheap
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+@instrument_view
+class WidgetBatchRenderView(ClassView):
+    """ Render several dashboard widgets in one request.
+        POST a JSON list of {"id": ..., "widget": <widget name>, "settings": {...}}, the response
+        is {"widgets": [{"id": ..., "html": ...} or {"id": ..., "error": ...}, ...]} in the same order.
+        Nothing in Portal calls this by itself, see widgetrender.py for how a page uses it.
+    """
+    def __call__(self):
+        if self.request.method != 'POST':
+            return HttpResponseBadRequest("Only POST is supported")
+        try:
+            # Makes sure the example widgets are registered
+            from . import dashboard_widget_examples
+        except ImportError:
+            # Dashboard widgets only work on portal 2.1 or later
+            return HttpResponseBadRequest("Dashboard widgets are not supported")
+        try:
+            specs = json.loads(self.request.body.decode('utf-8'))
+        except ValueError:
+            return HttpResponseBadRequest("Invalid JSON")
+        if not isinstance(specs, list) or not all(isinstance(spec, dict) for spec in specs):
+            return HttpResponseBadRequest("Expected a list of widgets")
+        if len(specs) > MAX_BATCH_WIDGETS:
+            return HttpResponseBadRequest("At most %d widgets can be rendered at once" % MAX_BATCH_WIDGETS)
+        return JsonResponse({"widgets": render_widgets(specs, self.request)})
+
+
+@instrument_view
+class ItemSubtitlesView(ClassView):
+    """ The subtitles of an item as WebVTT, converted from the item's subtitle shape and cached on disk.
+        Supports conditional requests (ETag) and single byte ranges.
+    """
+    def __call__(self):
+        item_id = self.kwargs.get('item_id')
+        try:
+            subtitle = resolve_subtitle(item_id, self.request.user)
+            if subtitle is None:
+                raise Http404("Item %s has no subtitles" % item_id)
+            etag = subtitle_etag(subtitle)
+            if self.request.META.get('HTTP_IF_NONE_MATCH') == etag:
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                return response
+            fileobj, size = open_cached_subtitle(subtitle)
+        except SubtitleError as e:
+            log.warning("Failed getting subtitles: %s" % e)
+            return HttpResponse(_("Subtitles are not available right now"), status=503, content_type='text/plain')
+
+        byte_range = None
+        # A range of an earlier version of the file is no good, send the whole file instead
+        if self.request.META.get('HTTP_IF_RANGE', etag) == etag:
+            try:
+                byte_range = parse_range(self.request.META.get('HTTP_RANGE'), size)
+            except ValueError:
+                fileobj.close()
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d' % size
+                return response
+        if byte_range is None:
+            response = StreamingHttpResponse(iter_file(fileobj, size), content_type='text/vtt; charset=utf-8')
+            response['Content-Length'] = str(size)
+        else:
+            first, last = byte_range
+            fileobj.seek(first)
+            response = StreamingHttpResponse(iter_file(fileobj, last - first + 1), status=206,
+                                             content_type='text/vtt; charset=utf-8')
+            response['Content-Length'] = str(last - first + 1)
+            response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+        response['Accept-Ranges'] = 'bytes'
+        response['ETag'] = etag
+        # Always revalidated, the answer depends on the user's access to the item
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+def metrics_view(request):
+    """ The plugin's metrics for this process, in the Prometheus text format.
+        A plain view rather than a ClassView, so it can be scraped without a session:
+        open to logged in superusers, to requests with METRICS_TOKEN and to METRICS_ALLOWED_IPS.
+    """
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    token_ok = bool(METRICS_TOKEN) and hmac.compare_digest(
+        authorization.encode('utf-8'), ('Bearer %s' % METRICS_TOKEN).encode('utf-8'))
+    if not (request.user.is_superuser or token_ok or request.META.get('REMOTE_ADDR') in METRICS_ALLOWED_IPS):
+        return HttpResponseForbidden()
+    return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def player_options_bundle(request, block, digest):
+    """ The JavaScript bundle of a pluginblock, see playerbundles.py.
+        A plain view rather than a ClassView, the bundle is the same for everybody.
+    """
+    bundle = get_bundle(block)
+    if bundle is None:
+        raise Http404("No bundle for %s" % block)
+    current_digest, content = bundle
+    etag = '"%s"' % current_digest
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type='application/javascript; charset=utf-8')
+    response['ETag'] = etag
+    if digest == current_digest:
+        response['Cache-Control'] = 'public, max-age=%d, immutable' % BUNDLE_MAX_AGE
+    else:
+        # A page rendered before the bundle changed, serve the current one but don't cache it under the old name
+        response['Cache-Control'] = 'no-cache'
+    return response
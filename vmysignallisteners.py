@@ -1,44 +1,126 @@
+import atexit
 import logging
+import os
+import threading
+import time
+from collections import OrderedDict
 from django.utils.translation import ugettext as _
-from portal.vidispine.igeneral import performVSAPICall
 
 from datetime import datetime, timedelta
+from xml.etree import ElementTree
 from portal.vidispine.isearch import SearchHelper
 from portal.vidispine.icollection import CollectionHelper
 from portal.vidispine.iitem import ItemHelper
+from . import metrics
+from .datastructures import BoundedOrderedSet, LibraryIndex
+from .executor import BoundedExecutor
+from .metadatadiff import (MetadataChangeSet, diff_timespans, diff_values, document_timespans,
+                           has_timespans, index_document)
+from .signals import item_metadata_changed, item_metadata_changing
+from .snapshots import MetadataSnapshotCache, document_field_values, document_snapshot
+from .spool import SharedVisitSpool
+from .vsclient import vsapi
 
 log = logging.getLogger(__name__)
 
+VS_NS = '{http://xml.vidispine.com/schema/vidispine}'
+
 # update every 30 seconds
 UPDATE_FREQUENCY = 30
+# max number of item ids waiting for the next flush, the oldest visits are evicted beyond this
+MAX_PENDING_ITEMS = 1000
+# max number of item ids kept for retrying after failed flushes, newer failures are dropped beyond this
+MAX_RETRY_ITEMS = 5000
+# Retention of the collection: at most this many items, none older than this many seconds (None to disable)
+MAX_COLLECTION_ITEMS = 10000
+MAX_COLLECTION_ITEM_AGE = 30 * 24 * 3600
+# max number of libraries removed from the collection per flush
+TRIM_BATCH_SIZE = 50
+# Give every user their own last visited items collection instead of one shared by all users
+PER_USER_COLLECTIONS = False
+# In per user mode, max number of user collections written per flush, other users wait for the next flush
+MAX_USER_WRITES_PER_FLUSH = 20
+# How long a resolved collection id is cached, in seconds
+COLLECTION_ID_TIMEOUT = 24 * 3600
+# How long one process may hold the lock for finding or creating a collection, in seconds
+COLLECTION_LOCK_TIMEOUT = 60
+
+# Diff metadata updates on a background thread pool instead of before the update is saved
+ASYNC_PRE_MODIFY = False
+PRE_MODIFY_WORKERS = 2
+# Max number of updates waiting to be diffed, and what to do when it is reached: 'drop' or 'block'
+PRE_MODIFY_QUEUE_SIZE = 1000
+PRE_MODIFY_QUEUE_POLICY = 'drop'
+# Seconds a diffed update waits for vidispine_post_modify to confirm it was saved. After that the save is
+# taken as failed and the changes are not sent with item_metadata_changed.
+PENDING_SAVE_TIMEOUT = 600
+
+RECEIVER_SECONDS = metrics.histogram('portalplugintemplate_signal_receiver_seconds',
+                                     "Time spent in the plugin's signal receivers", ['receiver'])
+FLUSH_SECONDS = metrics.histogram('portalplugintemplate_lastvisited_flush_seconds',
+                                  "Time spent writing last visited items to Vidispine")
+DIFF_SECONDS = metrics.histogram('portalplugintemplate_metadata_diff_seconds',
+                                 "Time spent diffing metadata updates, including fetching the current metadata")
 
 """
 This class puts all items visited by all users in a collection called "lastVisitedItems" with a frequency of min 30 seconds.
 
-a) Upon init, make sure there is a collection for last visited items called "lastVisitedItems" with the correct collection type
+a) On the first flush, make sure there is a collection for last visited items called "lastVisitedItems" with the
+   correct collection type. The id is cached in the Django cache, and only one process at a time looks it up.
 b) Subscribes to the "vidispine_get_item_ntfcn" signal which is raised everytime the system does the getItem API call to Vidispine
 c) When a user visits an item page, put the item id in the items list in the class
-d) If last update was over 30 seconds ago, update the collection with the new items and empty the items list
- 
+d) A background thread wakes up every 30 seconds and hands the new items to a spool shared by all Portal processes
+e) The one process that claims an interval in the spool updates the collection with the items from all processes
+f) The items of a flush are added to the collection as one library. Once the collection is over
+   MAX_COLLECTION_ITEMS or its libraries are older than MAX_COLLECTION_ITEM_AGE, the oldest libraries are
+   removed from the collection and deleted, a batch per flush. A visited item that is already in the collection
+   is added again with the new library, so its old library can go. What is in the collection is tracked in an
+   index stored in the Django cache, so the collection never has to be read back from Vidispine. Libraries
+   that were in the collection before the index existed are not tracked by it.
+
+With PER_USER_COLLECTIONS every user gets a collection of their own, and the spool coalesces visits into one
+library per user per flush. At most MAX_USER_WRITES_PER_FLUSH users are written per flush.
+
+The signal receiver never talks to Vidispine itself, so no user request has to wait for the collection update.
 """
 
 
 class LastVisitedItems(object):
-    def __init__(self):
-        self.items = []
+    def __init__(self, per_user=PER_USER_COLLECTIONS):
+        self.per_user = per_user
+        # collection type -> (collection id, expiry time), in front of the Django cache
+        self.collection_ids = {}
+        self.items = BoundedOrderedSet(MAX_PENDING_ITEMS)
+        # Items from failed flushes, capped so a Vidispine outage can't grow it without limit
+        self.retry_items = BoundedOrderedSet(MAX_RETRY_ITEMS, evict=False)
         self.lastUpdated = datetime.now() - timedelta(seconds=UPDATE_FREQUENCY)
-        # Make sure the collection is created, and get the id
-        self.collection_id = self.getOrCreateLastVisitedCollectionId()
+        self.spool = SharedVisitSpool('portalplugintemplate:lastvisited', UPDATE_FREQUENCY)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._worker = None
+        self._worker_pid = None
     
     def register(self):
         from portal.vidispine import signals
         # Subscribe to the signal with a callback function
         signals.vidispine_get_item_ntfcn.connect(self.receiver_itempage_visited)
+        # Write out whatever is still pending when the process exits
+        atexit.register(self.stop)
+        metrics.gauge('portalplugintemplate_lastvisited_pending_items',
+                      "Visited items waiting for the next flush", lambda: len(self.items))
+        metrics.gauge('portalplugintemplate_lastvisited_retry_items',
+                      "Items kept for retrying after failed flushes", lambda: len(self.retry_items))
+        metrics.gauge('portalplugintemplate_lastvisited_seconds_since_flush',
+                      "Seconds since this process last flushed the visited items",
+                      lambda: (datetime.now() - self.lastUpdated).total_seconds())
     
-    def getOrCreateLastVisitedCollectionId(self):
+    def getOrCreateLastVisitedCollectionId(self, collection_type='lastVisitedItems', runas=None):
         """ Attempt to make a search for the 'lastVisitedItems'. If none is found, create it.
+            Per user collections have a collection type of their own, and are created as the user.
         """
-        sh = SearchHelper()  # don't set the runas, so it is run as admin
+        # A helper of its own, as the search is configured on the helper.
+        # Don't set the runas, so it is run as admin
+        sh = SearchHelper()
         # Set the search domain to collections
         sh.searchdomain = 'collection'
         # Create the searchmetadata where portal_collectiontype_hidden is set to lastVisitedItems
@@ -46,88 +128,351 @@ class LastVisitedItems(object):
         sh.searchmetadata = {
             'fields': {
                 'portal_collectiontype_hidden': {
-                    'value': 'lastVisitedItems', 'type': 'string', 'extradata': {}
+                    'value': collection_type, 'type': 'string', 'extradata': {}
                 }
             }
         }
-        res = performVSAPICall(func=sh.search, args={'_content': {}, 'page': 1, 'queryamount': 1},
-                               vsapierror_templateorcode=500)
-        if not res['success'] or res['response'][0]['hits'] == 0:
-            # Either the search failed or there was no hits for the collection
-            return self.createLastVisitedCollection()
+        res = vsapi.call(func=sh.search, args={'_content': {}, 'page': 1, 'queryamount': 1},
+                         vsapierror_templateorcode=500, idempotent=True)
+        if not res['success']:
+            # Don't create a collection which may already exist, try again on the next flush
+            log.warning("Failed searching for the %s collection" % collection_type)
+            return None
+        if res['response'][0]['hits'] == 0:
+            # There was no hits for the collection
+            return self.createLastVisitedCollection(collection_type, runas)
         else:
             return res['response'][0]['collection'][0]['id']
 
-    def createLastVisitedCollection(self):
+    def createLastVisitedCollection(self, collection_type='lastVisitedItems', runas=None):
         """ This function is called if there is no last visited collection in the system    
         """
-        # Create the collection helper as admin (don't set the runas)
-        ch = CollectionHelper()
-        # Create a collection with the name lastVisitedItems
-        res = performVSAPICall(func=ch.createCollection, args={'collection_name': 'lastVisitedItems'},
-                               vsapierror_templateorcode=500)
+        # Create the collection helper as admin unless it is a per user collection
+        ch = vsapi.helper(CollectionHelper, runas=runas)
+        # Create a collection with the name lastVisitedItems. Not retried, a retry could create a second one.
+        res = vsapi.call(func=ch.createCollection, args={'collection_name': 'lastVisitedItems'},
+                         vsapierror_templateorcode=500)
         # If the call fails return
         if not res['success']:
             return
         # Get the ID
         collection_id = res['response'].getId()
         # Update a single metadata field value of the collection
-        res = performVSAPICall(func=ch.setCollectionMetadataFieldValue,
-                               args={
-                                   'collection_id': collection_id,
-                                   'field_name': 'portal_collectiontype_hidden',
-                                   'field_val': 'lastVisitedItems'},
-                               vsapierror_templateorcode=500)
+        res = vsapi.call(func=ch.setCollectionMetadataFieldValue,
+                         args={
+                             'collection_id': collection_id,
+                             'field_name': 'portal_collectiontype_hidden',
+                             'field_val': collection_type},
+                         vsapierror_templateorcode=500, idempotent=True)
         # Return the collection ID
         return collection_id
     
+    @RECEIVER_SECONDS.time('itempage_visited')
     def receiver_itempage_visited(self, instance, **kwargs):
         """ The subscriber function to the vidispine_get_item_ntfcn signal
+            Only records the item id, the collection is updated by the flusher thread
+        """
+        if self.per_user:
+            username = self._visitor(kwargs)
+            if not username:
+                log.debug("No user in getItem signal for %s, not recording visit" % instance)
+                return
+            # Spooled between processes, so only the username is kept
+            entry = (username, instance)
+        else:
+            entry = instance
+        with self._lock:
+            self.items.add(entry)
+        self._ensure_worker()
+
+    @staticmethod
+    def _visitor(signal_kwargs):
+        """ The username of the user the getItem call was made for, if any
         """
-        if instance not in self.items:
-            self.items.append(instance)
-            
-        # Check if it is time to update the last visited collection
-        now = datetime.now()
-        if (now - self.lastUpdated) > timedelta(seconds=UPDATE_FREQUENCY):
-            log.debug("Time to update!")
-            # Setting updated time to now in case something breaks in the API calls
-            # we still want the 30s delay so it doesn't flood the system
-            self.lastUpdated = now
-            ih = ItemHelper()  # run as admin
-            # A quick way of adding multiple items to a collection is to create a library of the items
-            # and then add the library instead
-            res = performVSAPICall(func=ih.createLibraryFromItemList, args={'item_id_list': self.items},
-                                   vsapierror_templateorcode=500)
-            if not res['success']:
-                log.warning("Failed updating last visited items collection. Couldn't create library from item list: %s" % self.items)
+        user = signal_kwargs.get('runas') or signal_kwargs.get('user')
+        return getattr(user, 'username', user)
+
+    def _ensure_worker(self):
+        """ Start the flusher thread if it isn't running in this process.
+            Checking the pid makes sure a worker forked from a parent that already
+            had a flusher gets a thread of its own.
+        """
+        if self._worker is not None and self._worker_pid == os.getpid() and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is not None and self._worker_pid == os.getpid() and self._worker.is_alive():
                 return
+            self._stop_event.clear()
+            self._worker_pid = os.getpid()
+            self._worker = threading.Thread(target=self._run, name='LastVisitedItemsFlusher')
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _run(self):
+        # Event.wait() returns True when stop() has been called
+        while not self._stop_event.wait(UPDATE_FREQUENCY):
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Unexpected error while updating last visited items collection")
+
+    def stop(self, timeout=None):
+        """ Stop the flusher thread and write any pending items to the collection
+        """
+        self._stop_event.set()
+        worker = self._worker
+        if worker is not None and worker.is_alive() and worker is not threading.current_thread():
+            worker.join(timeout)
+        self.flush(final=True)
+
+    @FLUSH_SECONDS.time()
+    def flush(self, final=False):
+        """ Publish the pending items to the shared spool and, if this process is the one that
+            claims the closed spool intervals, add the items from all processes to the collection.
+            A final flush writes this process' pending items directly, as there may not be
+            another flush to pick them up from the spool, together with what this process
+            published to the spool that no process has collected yet.
+            The pending items are drained under the lock, the API calls run without it.
+        """
+        with self._lock:
+            retry_items = self.retry_items.drain()
+            pending_items = self.items.drain()
+        self.lastUpdated = datetime.now()
+        if pending_items and not final:
+            try:
+                self.spool.publish(pending_items)
+                pending_items = []
+            except Exception:
+                log.exception("Failed publishing last visited items to the shared spool, writing them directly")
+        try:
+            spooled_items = self.spool.reclaim() if final else self.spool.collect()
+        except Exception:
+            log.exception("Failed collecting last visited items from the shared spool")
+            spooled_items = []
+
+        # Retry earlier failures first
+        items = []
+        seen = set()
+        for item in retry_items + pending_items + spooled_items:
+            if item not in seen:
+                seen.add(item)
+                items.append(item)
+        if not items:
+            log.debug("No last visited items to update")
+            return
+        self._write(items)
 
-            # Get the library ID
-            library_id = res['response']
-            ch = CollectionHelper()  # run as admin
-            # Add the library to the collection
-            res = performVSAPICall(func=ch.addLibraryToCollection,
-                                   args={'collection_id': self.collection_id, 'library_id': library_id},
-                                   vsapierror_templateorcode=500)
-            if not res['success']:
-                log.warning("Failed updating last visited items collection."
-                            " Couldn't add item list to collection: %s" % self.items)
-            # Clean the items list
-            self.items = []
-            log.debug("Updated last visited items successfully")
-                
+    def _write(self, items):
+        """ Add the items to the last visited collection(s) and trim them, failed items are kept for retrying
+        """
+        if not self.per_user:
+            self._requeue(self._write_collection(self.resolveCollectionId(), items))
+            return
+
+        # Coalesce into one library per user
+        items_by_user = OrderedDict()
+        for username, item in items:
+            items_by_user.setdefault(username, []).append(item)
+        writes = 0
+        for username, user_items in items_by_user.items():
+            if writes >= MAX_USER_WRITES_PER_FLUSH:
+                # Over the write budget for this flush, keep the rest for the next one
+                self._requeue([(username, item) for item in user_items])
+                continue
+            writes += 1
+            failed = self._write_collection(self.resolveCollectionId(username), user_items)
+            self._requeue([(username, item) for item in failed])
+
+    def resolveCollectionId(self, username=None):
+        """ Get the id of the shared collection, or of the user's collection if a username is given.
+            Resolved ids are cached in the Django cache, and a lock in the cache makes sure only one
+            process searches for and possibly creates the collection. Returns None if the id isn't
+            known yet, the items are then retried on the next flush.
+        """
+        collection_type = 'lastVisitedItems:%s' % username if username else 'lastVisitedItems'
+        collection_id, expires = self.collection_ids.get(collection_type, (None, 0))
+        if collection_id and expires > time.time():
+            return collection_id
+
+        from django.core.cache import cache
+        cache_key = 'portalplugintemplate:lastvisited:collection:%s' % collection_type
+        collection_id = cache.get(cache_key)
+        if not collection_id:
+            lock_key = cache_key + ':lock'
+            if not cache.add(lock_key, os.getpid(), COLLECTION_LOCK_TIMEOUT):
+                log.debug("Another process is resolving the %s collection" % collection_type)
+                return None
+            try:
+                # It may have been resolved while we were waiting for the lock
+                collection_id = cache.get(cache_key)
+                if not collection_id:
+                    collection_id = self._find_or_create_collection(collection_type, username)
+                if not collection_id:
+                    return None
+                cache.set(cache_key, collection_id, COLLECTION_ID_TIMEOUT)
+            finally:
+                cache.delete(lock_key)
+        self.collection_ids[collection_type] = (collection_id, time.time() + COLLECTION_ID_TIMEOUT)
+        return collection_id
+
+    def _find_or_create_collection(self, collection_type, username):
+        if not username:
+            return self.getOrCreateLastVisitedCollectionId(collection_type)
+        from django.contrib.auth import get_user_model
+        user = get_user_model().objects.filter(username=username).first()
+        if user is None:
+            log.warning("Unknown user %s, can't create last visited items collection" % username)
+            return None
+        return self.getOrCreateLastVisitedCollectionId(collection_type, runas=user)
+
+    def _write_collection(self, collection_id, items):
+        """ Add items to a collection and trim it. Returns the items that could not be added
+        """
+        if not collection_id:
+            return items
+        index = self._load_index(collection_id)
+        now = time.time()
+        failed = []
+        # Items already in the collection are added again, so they move to the newest library
+        library_id = self._add_to_collection(collection_id, items)
+        if library_id:
+            index.add(library_id, items, now)
+            log.debug("Updated last visited items in %s successfully" % collection_id)
         else:
-            log.debug("Not time to update yet...")
-            pass
+            failed = items
+        self._trim(collection_id, index, now)
+        self._save_index(collection_id, index)
+        return failed
+
+    def _add_to_collection(self, collection_id, items):
+        """ Add the items to the collection as a library, returns the library id or None if it failed
+        """
+        ih = vsapi.helper(ItemHelper)  # run as admin
+        # A quick way of adding multiple items to a collection is to create a library of the items
+        # and then add the library instead
+        res = vsapi.call(func=ih.createLibraryFromItemList, args={'item_id_list': items},
+                         vsapierror_templateorcode=500)
+        if not res['success']:
+            log.warning("Failed updating last visited items collection. Couldn't create library from item list: %s" % items)
+            return None
+
+        # Get the library ID
+        library_id = res['response']
+        ch = vsapi.helper(CollectionHelper)  # run as admin
+        # Add the library to the collection
+        res = vsapi.call(func=ch.addLibraryToCollection,
+                         args={'collection_id': collection_id, 'library_id': library_id},
+                         vsapierror_templateorcode=500, idempotent=True)
+        if not res['success']:
+            log.warning("Failed updating last visited items collection."
+                        " Couldn't add item list to collection: %s" % items)
+            return None
+        return library_id
+
+    def _trim(self, collection_id, index, now):
+        """ Remove at most TRIM_BATCH_SIZE of the oldest libraries that are beyond the retention limits
+            from the collection, and delete them
+        """
+        expired = index.expired(now, max_items=MAX_COLLECTION_ITEMS, max_age=MAX_COLLECTION_ITEM_AGE,
+                                limit=TRIM_BATCH_SIZE)
+        removed = 0
+        for library_id in expired:
+            try:
+                vsapi.request('collection/%s/%s' % (collection_id, library_id), method='DELETE').close()
+            except Exception as e:
+                if getattr(e, 'code', None) != 404:
+                    log.warning("Failed removing library %s from last visited items collection %s: %s"
+                                % (library_id, collection_id, e))
+                    # Try again on the next flush
+                    break
+            index.remove(library_id)
+            removed += 1
+            try:
+                # Nothing else uses the library
+                vsapi.request('library/%s' % library_id, method='DELETE').close()
+            except Exception as e:
+                log.warning("Failed deleting library %s: %s" % (library_id, e))
+        if removed:
+            log.debug("Removed %d expired libraries from last visited items collection %s" % (removed, collection_id))
+
+    @staticmethod
+    def _index_key(collection_id):
+        return 'portalplugintemplate:lastvisited:libraries:%s' % collection_id
+
+    def _load_index(self, collection_id):
+        from django.core.cache import cache
+        try:
+            index = cache.get(self._index_key(collection_id))
+        except Exception:
+            log.exception("Failed loading last visited items index")
+            index = None
+        return index if index is not None else LibraryIndex()
+
+    def _save_index(self, collection_id, index):
+        from django.core.cache import cache
+        try:
+            # Never expires, the retention limits keep it bounded
+            cache.set(self._index_key(collection_id), index, None)
+        except Exception:
+            log.exception("Failed saving last visited items index")
+
+    def _requeue(self, items):
+        """ Keep items from a failed flush in the retry backlog so the next flush retries them
+        """
+        if not items:
+            return
+        with self._lock:
+            rejected = self.retry_items.update(items)
+        if rejected:
+            log.warning("Last visited items retry backlog is full, dropped %d items" % rejected)
+
+    def stats(self):
+        """ Buffer sizes and eviction/overflow counters, for monitoring
+        """
+        with self._lock:
+            return {
+                'pending': len(self.items),
+                'pending_evictions': self.items.evictions,
+                'retry': len(self.retry_items),
+                'retry_overflows': self.retry_items.overflows,
+                'last_updated': self.lastUpdated,
+            }
 
 
 class PreMetadataUpdate(object):
+    """ Identifies the fields a metadata update is about to change, and sends them as a
+        MetadataChangeSet with the item_metadata_changing signal.
+
+        In async mode the signal handler only captures the update and the item's snapshot, and
+        the diff runs on a bounded thread pool, so saving metadata doesn't wait for it. The
+        snapshot must be from before the save, so an item without a cached snapshot is still
+        fetched by the signal handler: a worker could already see the saved metadata. Saves are
+        written through to the snapshot on the pool too, so only the first update of an item
+        (or one after a change outside Portal) waits for a fetch.
+
+        Once an update is both diffed and confirmed saved by the vidispine_post_modify signal,
+        its changes are sent again with item_metadata_changed, which the outbox stores. Updates
+        that fail to save are never confirmed and their changes are dropped.
+    """
+    def __init__(self, async_mode=ASYNC_PRE_MODIFY):
+        # Snapshots of current item metadata, so consecutive updates of an item don't all need a getItem
+        self.snapshots = MetadataSnapshotCache()
+        # item id -> updates waiting for their diff and/or their save, oldest first
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self.executor = None
+        if async_mode:
+            self.executor = BoundedExecutor('PreMetadataUpdate', workers=PRE_MODIFY_WORKERS,
+                                            queue_size=PRE_MODIFY_QUEUE_SIZE, policy=PRE_MODIFY_QUEUE_POLICY)
+
     def register(self):
         from portal.vidispine import signals
         # Subscribe to the vidispine_pre_modify signal with a callback function
         signals.vidispine_pre_modify.connect(self.receiver_itemmetadata_updated)
+        # Keep the snapshots up to date when items have been modified
+        signals.vidispine_post_modify.connect(self.receiver_item_modified)
 
+    @RECEIVER_SECONDS.time('itemmetadata_updated')
     def receiver_itemmetadata_updated(self, instance, **kwargs):
         """ The subscriber function to the vidispine_pre_modify signal
             This function compares the metadata form from the page that is
@@ -137,40 +482,186 @@ class PreMetadataUpdate(object):
         if kwargs.get('method') == 'setItemMetadata':
             log.debug('Received a setItemMetadata signal')
 
-            item_helper = ItemHelper()  # not setting runas, running as admin
-            # Set content to metadata and include extradata in case
-            # metadata field extra data need to be analyzed
-            content = {'content': ['metadata'], 'include': ['type', 'extradata']}
-            res = performVSAPICall(func=item_helper.getItem, args=(instance, content),
-                                   vsapierror_templateorcode=500)
-            
-            if not res['success']:
-                log.error("Failed getting item %s" % instance)
-                return
-            
-            _item = res['response']
-            _custom_metadata, _system_metadata, _system_specific_metadata = _item.getMetadata()
-        
             # the metadata document that represents the metadata form in the web
             update_metadata_document = kwargs['metadata_document']
-                        
-            timespans = update_metadata_document.timespan
-            for ts in timespans:
-                # We want to make sure to look at the timespan for -INF -> +INF
-                # This excludes timebased metadata
-                if ts.start == '-INF' and ts.end == '+INF':
-                    for field in ts.field:
-                        # Iterate through all fields
-                        current_field = _custom_metadata.getFieldByName(field.name)
-                        try:
-                            # Match each field where the current value is not equal to the
-                            # value in the form
-                            if field.value_[0].value() != current_field.getValue()[0]['value']:
-                                log.debug("This field %s is about to be changed!" % field.name)
-                                log.debug("Old value: %s" % current_field.getValue()[0]['value'])
-                                log.debug("New value: %s" % field.value_[0].value())
-                        except:
-                            # Something unexpected happened...
-                            pass
-                            
-                    break
+            entry = self._track(instance, update_metadata_document)
+            if self.executor is not None:
+                # Capture what the update is and what the item looks like before it is saved
+                snapshot = self.get_snapshot(instance, getattr(update_metadata_document, 'revision', None),
+                                             (), has_timespans(update_metadata_document))
+                task = None
+                if snapshot is not None:
+                    task = self.executor.submit(self.process_update, instance, update_metadata_document, snapshot,
+                                                fetch=False, entry=entry)
+                if task is None:
+                    self._complete(instance, entry, diffed=True)
+            else:
+                self.process_update(instance, update_metadata_document, entry=entry)
+
+    @DIFF_SECONDS.time()
+    def process_update(self, instance, update_metadata_document, snapshot=None, fetch=True, entry=None):
+        """ Diff a metadata update and send the changes with the item_metadata_changing signal
+        """
+        changeset = None
+        try:
+            changeset = self.diff(instance, update_metadata_document, snapshot, fetch)
+        except Exception:
+            log.exception("Failed comparing the metadata update of %s to the current metadata" % instance)
+            return
+        finally:
+            if entry is not None:
+                self._complete(instance, entry, changeset, diffed=True)
+        if changeset is not None:
+            for change in changeset:
+                log.debug("This field %s is about to be changed!" % change.name)
+                log.debug("Old value: %s" % change.old_values)
+                log.debug("New value: %s" % change.new_values)
+            for change in changeset.timespan_changes:
+                log.debug("Timespan %r" % change)
+            if changeset:
+                item_metadata_changing.send(sender=self.__class__, instance=instance, changeset=changeset)
+
+    def diff(self, instance, update_metadata_document, snapshot=None, fetch=True):
+        """ Compare a metadata document to the current metadata of the item. Returns a
+            MetadataChangeSet, or None if the current metadata couldn't be fetched.
+            Time based metadata is only compared if the document has any, spans the document
+            doesn't mention are left alone as Vidispine does when merging the update.
+            A snapshot captured earlier is used if it has everything needed, otherwise the
+            metadata is fetched unless `fetch` is False, when the update may already be saved.
+        """
+        new_index = index_document(update_metadata_document)
+        new_timespans = document_timespans(update_metadata_document)
+        if not MetadataSnapshotCache.covers(snapshot, new_index.values, bool(new_timespans)):
+            if not fetch:
+                log.warning("The metadata snapshot of %s doesn't cover the update, not diffing it" % instance)
+                return None
+            snapshot = self.get_snapshot(instance, getattr(update_metadata_document, 'revision', None),
+                                         new_index.values, bool(new_timespans))
+        if snapshot is None:
+            return None
+        timespan_changes = diff_timespans(snapshot['timespans'], new_timespans) if new_timespans else []
+        return MetadataChangeSet(instance, diff_values(instance, snapshot['fields'], new_index).changes,
+                                 timespan_changes)
+
+    def get_snapshot(self, instance, revision, field_names, need_timespans=False):
+        """ The current metadata of the item, from the snapshot cache if possible
+        """
+        snapshot = self.snapshots.get(instance, revision, field_names, need_timespans)
+        if snapshot is not None:
+            return snapshot
+
+        snapshot = self._fetch_snapshot(instance, revision)
+        if snapshot is not None:
+            self.snapshots.set(instance, snapshot)
+        return snapshot
+
+    def _fetch_snapshot(self, instance, revision):
+        item_helper = vsapi.helper(ItemHelper)  # not setting runas, running as admin
+        # The item's metadata document has both the -INF -> +INF fields and the time based spans,
+        # and is indexed once for all of its fields
+        res = vsapi.call(func=item_helper.getItemMetadata, args={'item_id': instance},
+                         vsapierror_templateorcode=500, idempotent=True)
+        if not res['success']:
+            log.error("Failed getting metadata of item %s" % instance)
+            return None
+        return document_snapshot(res['response'], revision)
+
+    def _fetch_revision(self, instance):
+        """ The current metadata revision of the item, None if it can't be read. Only the itemId
+            field is asked for, so the answer is small however much metadata the item has.
+        """
+        try:
+            response = vsapi.request('item/%s/metadata' % instance, {'field': 'itemId'},
+                                     headers={'Accept': 'application/xml'})
+            try:
+                document = ElementTree.parse(response).getroot()
+            finally:
+                response.close()
+        except Exception as e:
+            log.warning("Failed getting the metadata revision of %s: %s" % (instance, e))
+            return None
+        return document.findtext('.//%srevision' % VS_NS)
+
+    def _write_through(self, instance, metadata_document):
+        """ Write a saved metadata update through to the item's snapshot, under the revision the
+            save gave the item
+        """
+        with self._pending_lock:
+            # Another update of the item may be saved before the revision is read
+            unsaved = any(not e['saved'] for e in self._pending.get(instance, []))
+        revision = None if unsaved else self._fetch_revision(instance)
+        self.snapshots.update(instance, document_field_values(metadata_document), revision,
+                              timespans_changed=bool(document_timespans(metadata_document)))
+
+    def stats(self):
+        """ Snapshot cache counters and, in async mode, queue depth and processing latency
+        """
+        stats = {'snapshots': self.snapshots.stats()}
+        if self.executor is not None:
+            stats['executor'] = self.executor.stats()
+        return stats
+
+    def _track(self, instance, update_metadata_document):
+        """ Start tracking an update until it is both diffed and saved, dropping updates whose
+            save was never confirmed
+        """
+        now = time.time()
+        entry = {'document': update_metadata_document, 'changeset': None, 'diffed': False, 'saved': False,
+                 'expires': now + PENDING_SAVE_TIMEOUT}
+        with self._pending_lock:
+            for item_id in list(self._pending):
+                entries = [e for e in self._pending[item_id] if e['expires'] > now]
+                if entries:
+                    self._pending[item_id] = entries
+                else:
+                    del self._pending[item_id]
+            self._pending.setdefault(instance, []).append(entry)
+        return entry
+
+    def _complete(self, instance, entry, changeset=None, diffed=False, saved=False):
+        """ Record that an update was diffed or saved, and once both have happened send its
+            changes with item_metadata_changed
+        """
+        with self._pending_lock:
+            if diffed:
+                entry['diffed'] = True
+                entry['changeset'] = changeset
+            if saved:
+                entry['saved'] = True
+            if not (entry['diffed'] and entry['saved']):
+                return
+            entries = [e for e in self._pending.get(instance, []) if e is not entry]
+            if entries:
+                self._pending[instance] = entries
+            else:
+                self._pending.pop(instance, None)
+        if entry['changeset']:
+            item_metadata_changed.send(sender=self.__class__, instance=instance, changeset=entry['changeset'])
+
+    def _saved(self, instance, metadata_document):
+        """ Confirm the save of the update with this metadata document, or else the oldest update
+            of the item that isn't confirmed yet
+        """
+        with self._pending_lock:
+            entries = [e for e in self._pending.get(instance, []) if not e['saved']]
+            entry = next((e for e in entries if e['document'] is metadata_document), None)
+            if entry is None and entries:
+                entry = entries[0]
+        if entry is not None:
+            self._complete(instance, entry, saved=True)
+
+    @RECEIVER_SECONDS.time('item_modified')
+    def receiver_item_modified(self, instance, **kwargs):
+        """ The subscriber function to the vidispine_post_modify signal
+            Confirms a metadata update was saved, and writes the saved metadata through to the item's
+            snapshot. Any other modification invalidates the snapshot.
+        """
+        if kwargs.get('method') == 'setItemMetadata' and kwargs.get('metadata_document') is not None:
+            metadata_document = kwargs['metadata_document']
+            self._saved(instance, metadata_document)
+            if self.executor is None:
+                self._write_through(instance, metadata_document)
+            elif self.executor.submit(self._write_through, instance, metadata_document) is None:
+                self.snapshots.invalidate(instance)
+        else:
+            self.snapshots.invalidate(instance)
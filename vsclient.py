@@ -0,0 +1,367 @@
+"""
+One place for all of the plugin's calls to Vidispine.
+
+    from .vsclient import vsapi
+
+    ch = vsapi.helper(CollectionHelper)
+    res = vsapi.call(func=ch.addLibraryToCollection, args={...}, vsapierror_templateorcode=500, idempotent=True)
+
+call() takes the same arguments and returns the same result as Portal's
+performVSAPICall, and adds:
+
+* Helper reuse: helper() hands out one helper per helper class and runas
+  user per thread, instead of a new one per call. Helpers which are
+  configured before a call (such as SearchHelper) should still be created
+  per call.
+* Retries: failed calls marked idempotent are retried with jittered
+  exponential backoff, within an overall time budget per call.
+* A circuit breaker: after VSAPI_BREAKER_THRESHOLD consecutive failures
+  calls fail immediately for VSAPI_BREAKER_RESET seconds, after which a
+  single trial call decides whether Vidispine is healthy again.
+
+request() makes plain HTTP requests to the Vidispine API, with a socket
+timeout and the same retries and circuit breaker. Every thread keeps one
+keep-alive connection to Vidispine, which a request uses unless the thread
+still has an earlier response open; a connection that Vidispine closed while
+idle is replaced once without counting as a failure. The base URL and
+credentials are taken from Portal's VSAPI_* settings unless given, so it can
+be pointed at a local fake Vidispine server, such as the one in
+fakevidispine.py which `manage.py check_vsapi_client` runs the client against.
+
+VSAPI_TIMEOUT is the socket timeout of request(), and the time budget for
+the retries of both call() and request(). Calls made through Portal's
+helpers have no socket timeout of their own: a hanging helper call is not
+cut short, the budget only stops further retries.
+
+A call which gets an answer from Vidispine, a 4xx error included, closes the
+circuit breaker. A call which fails with a 5xx error, can't reach Vidispine
+or raises counts as a failure.
+"""
+import base64
+import logging
+import random
+import threading
+import time
+
+from io import BytesIO
+
+try:
+    from http.client import HTTPConnection, HTTPException, HTTPSConnection
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlencode, urlsplit
+except ImportError:
+    from httplib import HTTPConnection, HTTPException, HTTPSConnection
+    from urllib import urlencode
+    from urllib2 import HTTPError, URLError
+    from urlparse import urlsplit
+
+from portal.vidispine.igeneral import performVSAPICall
+
+from . import metrics
+from .datastructures import LRUCache
+
+log = logging.getLogger(__name__)
+
+# Seconds within which calls are retried, and the socket timeout of request(). Helper calls have no socket timeout.
+VSAPI_TIMEOUT = 10
+# Retries of idempotent calls, and the backoff before the first retry in seconds (doubled for every retry)
+VSAPI_RETRIES = 2
+VSAPI_BACKOFF = 0.2
+# Consecutive failures that open the circuit breaker, and seconds until a trial call is let through
+VSAPI_BREAKER_THRESHOLD = 5
+VSAPI_BREAKER_RESET = 30
+# Helpers kept per thread, the least recently used are dropped beyond this, and seconds a helper is reused
+HELPERS_PER_THREAD = 100
+HELPER_TIMEOUT = 3600
+
+
+CALL_SECONDS = metrics.histogram('portalplugintemplate_vsapi_call_seconds',
+                                 "Time spent in Vidispine calls, including retries", ['function'])
+CALL_FAILURES = metrics.counter('portalplugintemplate_vsapi_call_failures_total',
+                                "Vidispine calls which failed after any retries", ['function'])
+CALL_RETRIES = metrics.counter('portalplugintemplate_vsapi_call_retries_total',
+                               "Retries of idempotent Vidispine calls", ['function'])
+CALL_REJECTED = metrics.counter('portalplugintemplate_vsapi_call_rejected_total',
+                                "Vidispine calls failed fast by the open circuit breaker", ['function'])
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=VSAPI_BREAKER_THRESHOLD, reset_timeout=VSAPI_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ Whether a call may be made now. In the half-open state only one trial call is allowed.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    log.warning("Vidispine circuit breaker opened after %d failures" % self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+def _client_error(res):
+    """ Whether a failed performVSAPICall result is a 4xx error, which retrying won't fix
+        and which doesn't say anything about the health of Vidispine
+    """
+    status = (res.get('exception') or {}).get('status')
+    try:
+        return 400 <= int(status) < 500
+    except (TypeError, ValueError):
+        return False
+
+
+class _Response(object):
+    """ A response of request(), which gives its connection back to the thread once it has been
+        read to the end and closed
+    """
+    def __init__(self, client, key, connection, response):
+        self._client = client
+        self._key = key
+        self._connection = connection
+        self._response = response
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def getcode(self):
+        return self._response.status
+
+    def info(self):
+        return self._response.msg
+
+    def close(self):
+        if self._connection is None:
+            return
+        connection, self._connection = self._connection, None
+        # A response closed part way leaves the rest of it on the connection
+        reusable = self._response.isclosed() and not self._response.will_close
+        self._response.close()
+        if reusable:
+            self._client._release(self._key, connection)
+        else:
+            connection.close()
+
+
+class VSClient(object):
+    def __init__(self, timeout=VSAPI_TIMEOUT, retries=VSAPI_RETRIES, backoff=VSAPI_BACKOFF, breaker=None,
+                 base_url=None, username=None, password=None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.base_url = base_url
+        self.username = username
+        self.password = password
+        self._local = threading.local()
+
+    def helper(self, helper_class, runas=None):
+        """ A helper of the given class for the current thread, created on first use
+        """
+        helpers = getattr(self._local, 'helpers', None)
+        if helpers is None:
+            helpers = self._local.helpers = LRUCache(HELPERS_PER_THREAD, HELPER_TIMEOUT)
+        key = (helper_class, getattr(runas, 'username', runas))
+        now = time.time()
+        helper = helpers.get(key, now)
+        if helper is None:
+            helper = helper_class(runas=runas)
+            helpers.set(key, helper, now)
+        return helper
+
+    def _backoff(self, attempt):
+        # Full jitter around the exponential backoff, so retrying processes don't synchronize
+        return self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+
+    def call(self, func, args, vsapierror_templateorcode=500, idempotent=False):
+        """ performVSAPICall with retries for idempotent calls and the circuit breaker
+        """
+        name = getattr(func, '__name__', 'unknown')
+        start = time.time()
+        res = self._call(name, func, args, vsapierror_templateorcode, idempotent)
+        CALL_SECONDS.observe(time.time() - start, name)
+        if not res['success']:
+            CALL_FAILURES.inc(name)
+        return res
+
+    def _call(self, name, func, args, vsapierror_templateorcode, idempotent):
+        if not self.breaker.allow():
+            CALL_REJECTED.inc(name)
+            return {'success': False, 'response': None,
+                    'exception': {'error': "Vidispine is unavailable (circuit breaker open)"}}
+        deadline = time.time() + self.timeout
+        attempt = 0
+        # Every way out records an outcome, or a half-open breaker would never close again
+        healthy = False
+        try:
+            while True:
+                res = performVSAPICall(func=func, args=args, vsapierror_templateorcode=vsapierror_templateorcode)
+                if res['success'] or _client_error(res):
+                    # Vidispine answered, a 4xx is a problem of the call and not of Vidispine
+                    healthy = True
+                    return res
+                attempt += 1
+                delay = self._backoff(attempt)
+                if not idempotent or attempt > self.retries or time.time() + delay > deadline:
+                    return res
+                log.debug("Retrying %s in %.2fs" % (name, delay))
+                CALL_RETRIES.inc(name)
+                time.sleep(delay)
+        finally:
+            if healthy:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+    def _settings(self):
+        if self.base_url and self.username and self.password is not None:
+            return self.base_url.rstrip('/'), self.username, self.password
+        from django.conf import settings
+        base_url = self.base_url or '%s:%s' % (getattr(settings, 'VSAPI_BASE', 'http://localhost'),
+                                               getattr(settings, 'VSAPI_PORT', 8080))
+        username = self.username or getattr(settings, 'VSAPI_USER', 'admin')
+        password = self.password if self.password is not None else getattr(settings, 'VSAPI_PASSWORD', '')
+        return base_url.rstrip('/'), username, password
+
+    def request(self, path, params=None, headers=None, method='GET', runas=None):
+        """ Make a request to the Vidispine API (path relative to /API/) and return the open
+            response, to be read and closed by the caller. GET requests are retried.
+            Raises HTTPError for error responses, CircuitOpenError while the breaker is open
+            and URLError or socket errors if Vidispine can't be reached.
+        """
+        name = 'http_%s' % method
+        start = time.time()
+        try:
+            return self._request(name, path, params, headers, method, runas)
+        except Exception:
+            CALL_FAILURES.inc(name)
+            raise
+        finally:
+            CALL_SECONDS.observe(time.time() - start, name)
+
+    def _request(self, name, path, params, headers, method, runas):
+        if not self.breaker.allow():
+            CALL_REJECTED.inc(name)
+            raise CircuitOpenError("Vidispine is unavailable (circuit breaker open)")
+        base_url, username, password = self._settings()
+        url = '%s/API/%s' % (base_url, path.lstrip('/'))
+        if params:
+            url += '?' + urlencode(params, True)
+        credentials = base64.b64encode(('%s:%s' % (username, password)).encode('utf-8')).decode('ascii')
+        request_headers = {'Authorization': 'Basic %s' % credentials}
+        if runas is not None:
+            request_headers['RunAs'] = getattr(runas, 'username', runas)
+        request_headers.update(headers or {})
+        deadline = time.time() + self.timeout
+        attempt = 0
+        healthy = False
+        try:
+            while True:
+                try:
+                    response = self._send(url, method, request_headers)
+                except HTTPError as e:
+                    if 400 <= e.code < 500:
+                        healthy = True
+                        raise
+                    error = e
+                except URLError as e:
+                    error = e
+                else:
+                    healthy = True
+                    return response
+                attempt += 1
+                delay = self._backoff(attempt)
+                if method != 'GET' or attempt > self.retries or time.time() + delay > deadline:
+                    raise error
+                log.debug("Retrying %s %s in %.2fs" % (method, path, delay))
+                CALL_RETRIES.inc(name)
+                time.sleep(delay)
+        finally:
+            if healthy:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+    def _connect(self, url):
+        scheme, netloc = urlsplit(url)[:2]
+        key = (scheme, netloc)
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and connection[0] == key:
+            # In use until its response is closed
+            self._local.connection = None
+            return key, connection[1], True
+        connection_class = HTTPSConnection if scheme == 'https' else HTTPConnection
+        return key, connection_class(netloc, timeout=self.timeout), False
+
+    def _release(self, key, connection):
+        idle = getattr(self._local, 'connection', None)
+        if idle is not None:
+            # Another response of the thread was closed first
+            idle[1].close()
+        self._local.connection = (key, connection)
+
+    def _send(self, url, method, headers):
+        """ Send a request on the thread's connection. Returns a _Response, raises HTTPError for
+            error responses and URLError if Vidispine can't be reached.
+        """
+        scheme, netloc, path, query = urlsplit(url)[:4]
+        selector = '%s?%s' % (path, query) if query else path
+        while True:
+            key, connection, reused = self._connect(url)
+            sent = False
+            try:
+                connection.request(method, selector, headers=headers)
+                sent = True
+                response = connection.getresponse()
+            except (HTTPException, IOError, OSError) as e:
+                connection.close()
+                # Vidispine closes idle connections, try once more on a new one. Only GET requests are
+                # sent again once they have reached Vidispine.
+                if reused and (not sent or method == 'GET'):
+                    continue
+                raise URLError(e)
+            break
+        if response.status >= 400:
+            try:
+                body = response.read()
+            except (HTTPException, IOError, OSError):
+                body = b''
+            _Response(self, key, connection, response).close()
+            raise HTTPError(url, response.status, response.reason, response.msg, BytesIO(body))
+        return _Response(self, key, connection, response)
+
+
+# The client used by the plugin
+vsapi = VSClient()
+
+metrics.gauge('portalplugintemplate_vsapi_circuit_open',
+              "Whether Vidispine calls are failing fast (1) or not (0)",
+              lambda: 0 if vsapi.breaker.state == CircuitBreaker.CLOSED else 1)
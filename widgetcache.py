@@ -0,0 +1,135 @@
+"""
+Opt-in caching of dashboard widget render data.
+
+A widget plugin decorates its get_render_data() with cached_render_data(),
+giving the widget's name and how long the data may be cached:
+
+    class MyWidget(Plugin):
+        implements(IDashboardWidget)
+
+        @staticmethod
+        @cached_render_data('MyWidget', timeout=60)
+        def get_render_data(render_data, settings, request):
+            ...
+
+get_render_data() keeps its signature, so it can be called on the class as
+well as on the plugin instance.
+
+Render data is cached in the Django cache per widget name, hash of the
+widget settings, language and, if the widget asks for it, the user or
+permission scope. Only the keys get_render_data() adds or changes are
+cached, render_data itself holds per-request values such as the widget id.
+
+Entries are stale-while-revalidate: after `timeout` seconds the cached data
+is still served while one process recomputes it in the background, and only
+one process computes a missing entry while the others wait for it. The
+decorated function gets a widgetrender.WidgetRequest rather than the
+request, as it may run on a pool thread after the request has finished.
+invalidate_render_data() drops all cached data of a widget.
+"""
+import functools
+import hashlib
+import json
+import logging
+
+from .caching import StaleWhileRevalidateCache
+from .widgetrender import WidgetRequest
+# Note: The following package must be imported at call-time in methods to prevent circular dependencies:
+# from django.core.cache import cache
+# from django.utils import translation
+
+log = logging.getLogger(__name__)
+
+WIDGET_CACHE_TIMEOUT = 60
+# How long the last good render data is served if recomputing it keeps failing
+WIDGET_CACHE_STALE_TIMEOUT = 600
+
+# Who cached render data is shared with
+SCOPE_SHARED = 'shared'
+SCOPE_USER = 'user'
+# All superusers share the data, other users get their own
+SCOPE_PERMISSION = 'permission'
+
+_caches = {}
+
+
+def _render_cache(timeout, stale_timeout):
+    key = (timeout, stale_timeout)
+    if key not in _caches:
+        _caches[key] = StaleWhileRevalidateCache('portalplugintemplate:widget', timeout, stale_timeout)
+    return _caches[key]
+
+
+def _generation_key(widget_name):
+    return 'portalplugintemplate:widget:%s:generation' % widget_name
+
+
+def _generation(widget_name):
+    from django.core.cache import cache
+    return cache.get(_generation_key(widget_name), 0)
+
+
+def invalidate_render_data(widget_name):
+    """ Drop the cached render data of a widget, for all settings and users
+    """
+    from django.core.cache import cache
+    key = _generation_key(widget_name)
+    # Entries of earlier generations are never read again and expire on their own
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted between add() and incr()
+        cache.set(key, 1, None)
+
+
+def settings_hash(settings):
+    """ A stable hash of a widget settings dict
+    """
+    encoded = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+def render_cache_key(widget_name, settings, request, scope=SCOPE_SHARED):
+    from django.utils import translation
+    if scope == SCOPE_USER:
+        scope_key = 'user:%s' % request.user.pk
+    elif scope == SCOPE_PERMISSION:
+        scope_key = 'superuser' if request.user.is_superuser else 'user:%s' % request.user.pk
+    else:
+        scope_key = 'shared'
+    # Render data usually contains translated strings
+    return '%s:%s:%s:%s:%s' % (widget_name, _generation(widget_name), scope_key, translation.get_language(),
+                               settings_hash(settings))
+
+
+def cached_render_data(widget_name, timeout=WIDGET_CACHE_TIMEOUT, stale_timeout=WIDGET_CACHE_STALE_TIMEOUT,
+                       scope=SCOPE_SHARED):
+    """ Decorator caching what a get_render_data(render_data, settings, request) function computes,
+        see the module documentation
+    """
+    def decorator(get_render_data):
+        @functools.wraps(get_render_data)
+        def wrapper(render_data, settings, request):
+            from django.utils import translation
+            base = dict(render_data)
+            # Stale entries are recomputed on a pool thread, which has no active language of its own
+            # and mustn't touch the HttpRequest
+            language = translation.get_language()
+            widget_request = request if isinstance(request, WidgetRequest) else WidgetRequest(request)
+
+            def compute():
+                with translation.override(language):
+                    computed = get_render_data(dict(base), settings, widget_request)
+                return dict((key, value) for key, value in computed.items()
+                            if key not in base or base[key] != value)
+
+            try:
+                key = render_cache_key(widget_name, settings, request, scope)
+            except Exception:
+                log.exception("Failed building the render cache key of %s, rendering uncached" % widget_name)
+                return get_render_data(render_data, settings, request)
+            render_data.update(_render_cache(timeout, stale_timeout).get(key, compute))
+            return render_data
+        return wrapper
+    return decorator
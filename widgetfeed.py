@@ -0,0 +1,67 @@
+"""
+Shared, conditional payloads for dashboard widgets that refresh themselves.
+
+Instead of re-rendering the whole widget for every open dashboard, widgets
+poll a small JSON payload. The payload is computed once per refresh interval
+for everybody: time is divided in buckets of `interval` seconds and each
+bucket has one cache entry, computed by whichever request gets there first
+while the others wait for it. Every payload carries an ETag of its content,
+so clients that already have the current content get a 304 without a body,
+and the load depends on how often the data changes rather than on how many
+dashboards are open.
+
+A client may also ask to wait (long-poll) for the content to change, for at
+most FEED_MAX_WAIT seconds. That holds a server thread per waiting client, so
+it should only be used where the server has threads to spare.
+"""
+import hashlib
+import json
+import time
+
+from .caching import StaleWhileRevalidateCache
+# Note: The following package must be imported at call-time in methods to prevent circular dependencies:
+# from django.utils import translation
+
+# Longest a client may wait for new content, in seconds
+FEED_MAX_WAIT = 30
+MIN_INTERVAL = 1
+MAX_INTERVAL = 3600
+
+
+def _etag(content):
+    encoded = json.dumps(content, sort_keys=True, default=str)
+    return '"%s"' % hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+def current_payload(name, interval, compute, now=None):
+    """ The payload of the current interval, {'content': compute(), 'etag': ...}
+    """
+    from django.utils import translation
+    if now is None:
+        now = time.time()
+    bucket = int(now // interval)
+    # Payloads are never refreshed in place, every bucket gets a key of its own
+    cache = StaleWhileRevalidateCache('portalplugintemplate:widgetfeed', interval * 2, interval * 2)
+
+    def compute_payload():
+        content = compute()
+        return {'content': content, 'etag': _etag(content)}
+
+    return cache.get('%s:%s:%s:%s' % (name, translation.get_language(), interval, bucket), compute_payload)
+
+
+def wait_for_change(name, interval, compute, etag, max_wait):
+    """ The current payload, or when it has the given etag the first payload of a later
+        interval that differs from it. Returns the unchanged payload after max_wait seconds.
+    """
+    deadline = time.time() + min(max_wait, FEED_MAX_WAIT)
+    payload = current_payload(name, interval, compute)
+    while payload['etag'] == etag:
+        now = time.time()
+        # Sleep until the next interval starts
+        next_bucket = (int(now // interval) + 1) * interval
+        if next_bucket > deadline:
+            break
+        time.sleep(max(0, next_bucket - now))
+        payload = current_payload(name, interval, compute, next_bucket)
+    return payload
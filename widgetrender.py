@@ -0,0 +1,156 @@
+"""
+Rendering of several dashboard widgets in one request.
+
+Widget plugins are registered by name with register_widget(), and
+render_widgets() renders a list of {'id', 'widget', 'settings'} specs. The
+render data of independent widgets is computed concurrently on a small
+thread pool, the templates are then rendered on the request thread. A widget
+which fails, or isn't done WIDGET_RENDER_TIMEOUT seconds after the batch
+started, gets an error instead of holding up the others.
+
+HttpRequest isn't thread-safe, so widgets computing their render data on the
+pool get a WidgetRequest instead: the user, loaded on the request thread,
+and the request's method, path, GET, META, COOKIES and LANGUAGE_CODE. Widgets
+that need the session or messages can't be batched.
+
+Portal's dashboard loads every widget with a request of its own. A page that
+wants its widgets in one request POSTs their specs to the render_widgets URL
+(WidgetBatchRenderView) and puts the returned HTML in place, e.g.
+
+    $.ajax({url: renderWidgetsUrl, type: 'POST', contentType: 'application/json',
+             data: JSON.stringify(specs), headers: {'X-CSRFToken': csrfToken}})
+     .done(function(data) {
+         $.each(data.widgets, function(i, widget) {
+             $('#' + widget.id).html(widget.html || widget.error);
+         });
+     });
+
+get_config_form() of a widget normally defines a new form class on every
+call. memoized_config_form caches the class per get_config_form function,
+which is only correct for forms that don't depend on the settings or the
+request. Such forms should use lazy translations for their labels, as the
+class is shared by all users.
+"""
+import functools
+import logging
+import threading
+import time
+
+from .executor import BoundedExecutor
+# Note: The following package must be imported at call-time in methods to prevent circular dependencies:
+# from django.template import loader
+# from django.utils import translation
+
+log = logging.getLogger(__name__)
+
+MAX_BATCH_WIDGETS = 50
+# Seconds to wait for the widgets of a batch before answering with an error for those not done
+WIDGET_RENDER_TIMEOUT = 20
+
+# Widgets that don't fit in the queue are rendered on the request thread
+_render_executor = BoundedExecutor('WidgetRender', workers=4, queue_size=100)
+
+_widgets = {}
+_config_forms = {}
+_config_forms_lock = threading.Lock()
+
+
+def register_widget(widget):
+    """ Make a widget plugin instance available to render_widgets() by its name, returns the widget
+    """
+    _widgets[widget.name] = widget
+    return widget
+
+
+def get_widget(name):
+    return _widgets.get(name)
+
+
+def memoized_config_form(get_config_form):
+    """ Decorator for a get_config_form(settings, request) whose form class is the same for every call
+    """
+    @functools.wraps(get_config_form)
+    def wrapper(settings, request):
+        form_class = _config_forms.get(get_config_form)
+        if form_class is None:
+            with _config_forms_lock:
+                form_class = _config_forms.get(get_config_form)
+                if form_class is None:
+                    form_class = _config_forms[get_config_form] = get_config_form(settings, request)
+        return form_class
+    return wrapper
+
+
+class WidgetRequest(object):
+    """ A read-only stand-in for the request, for widgets computing their render data on the pool
+    """
+    def __init__(self, request):
+        user = request.user
+        # Loads the lazy user now, on the request thread
+        getattr(user, 'pk', None)
+        self.user = user
+        self.method = request.method
+        self.path = request.path
+        self.GET = request.GET
+        self.META = dict(request.META)
+        self.COOKIES = dict(request.COOKIES)
+        self.LANGUAGE_CODE = getattr(request, 'LANGUAGE_CODE', None)
+
+
+def widget_render_data(widget, widget_id, settings, request, language=None):
+    """ The render data of a widget
+    """
+    from django.utils import translation
+    # The active language is per thread
+    with translation.override(language):
+        render_data = {'id': widget_id, 'title': widget.get_list_title()}
+        return widget.get_render_data(render_data, settings, request)
+
+
+def render_widget(widget, widget_id, settings, request, language=None):
+    """ The HTML of a widget
+    """
+    from django.template import loader
+    render_data = widget_render_data(widget, widget_id, settings, request, language)
+    return loader.render_to_string(widget.template_name, render_data, request=request)
+
+
+def render_widgets(specs, request):
+    """ Render a list of {'id', 'widget', 'settings'} dicts. Returns a list of {'id', 'html'}
+        or, for widgets that are unknown or failed, {'id', 'error'} dicts in the same order.
+    """
+    from django.template import loader
+    from django.utils import translation
+    language = translation.get_language()
+    widget_request = WidgetRequest(request)
+    tasks = []
+    for spec in specs:
+        widget = get_widget(spec.get('widget'))
+        if widget is None:
+            tasks.append((spec, None, None, "Unknown widget"))
+            continue
+        task = _render_executor.submit(widget_render_data, widget, spec.get('id'), spec.get('settings') or {},
+                                       widget_request, language)
+        tasks.append((spec, widget, task, None))
+
+    deadline = time.time() + WIDGET_RENDER_TIMEOUT
+    results = []
+    for spec, widget, task, error in tasks:
+        result = {'id': spec.get('id')}
+        if error is None:
+            try:
+                if task is None:
+                    # The pool was full
+                    render_data = widget_render_data(widget, spec.get('id'), spec.get('settings') or {},
+                                                     widget_request, language)
+                else:
+                    render_data = task.result(max(0, deadline - time.time()))
+                # Templates are rendered here, context processors use the request's session and CSRF state
+                result['html'] = loader.render_to_string(widget.template_name, render_data, request=request)
+            except Exception as e:
+                log.warning("Failed rendering widget %s: %s" % (spec.get('widget'), e))
+                error = "Failed rendering widget"
+        if error is not None:
+            result['error'] = error
+        results.append(result)
+    return results